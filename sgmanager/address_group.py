@@ -0,0 +1,86 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+import logging
+
+from .exceptions import InvalidConfiguration
+from .rule import EtherType, _network
+from .utils import Base
+
+logger = logging.getLogger(__name__)
+
+
+class AddressGroup(Base):
+    '''Named set of addresses, maps to Neutron's address group.'''
+    def __init__(self, name, description=None, addresses=None, tags=None):
+        self.name = name
+        self.description = description
+        self.addresses = addresses
+        self.tags = tags
+        self._project = None
+        self._id = None
+
+    def to_dict(self, user=False):
+        '''Convert object to dictionary, mangling options for best user view if requested.'''
+        addresses = tuple(sorted(self.addresses, key=lambda net: (net.version, net)))
+        if user:
+            d = {}
+            if self._description is not None and self.description != self.name:
+                d['description'] = self.description
+            d['addresses'] = addresses
+            return d
+        else:
+            return {'name': self.name,
+                    'description': self.description,
+                    'addresses': addresses}
+
+    @property
+    def description(self):
+        return self._description or self.name
+
+    @description.setter
+    def description(self, value):
+        self._description = value
+
+    @property
+    def addresses(self):
+        return self._addresses
+
+    @addresses.setter
+    def addresses(self, value):
+        self._addresses = frozenset(_network(addr) for addr in value or ())
+
+    @property
+    def ethertypes(self):
+        '''EtherTypes of addresses, sorted.'''
+        versions = set(addr.version for addr in self.addresses)
+        return [ethertype for version, ethertype in ((4, EtherType.IPv4), (6, EtherType.IPv6))
+                if version in versions]
+
+    def __hash__(self):
+        d = self.to_dict(True)
+        d['name'] = self.name
+        return hash(frozenset(d.items()))
+
+    @classmethod
+    def from_remote(cls, **kwargs):
+        '''Create address group from OpenStack's json output.'''
+        logger.debug(f'Creating remote address group: {kwargs}')
+        group = cls(name=kwargs['name'],
+                    description=kwargs.get('description'),
+                    addresses=kwargs.get('addresses'),
+                    tags=kwargs.get('tags'))
+        group._id = kwargs['id']
+        group._project = kwargs.get('project_id')
+        return group
+
+    @classmethod
+    def from_local(cls, **kwargs):
+        '''Create address group from local configuration.'''
+        logger.debug(f'Creating local address group: {kwargs}')
+        return cls(**kwargs)
+
+    def validate(self):
+        '''Validate address group.'''
+        if not self.addresses:
+            raise InvalidConfiguration(f'Address group {self.name!r} has no addresses')
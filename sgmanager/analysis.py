@@ -0,0 +1,233 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+from collections import Counter, namedtuple
+import hashlib
+import logging
+import random
+
+from .rule import EtherType
+
+logger = logging.getLogger(__name__)
+
+# Mersenne prime larger than any hash value
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 61) - 1
+
+Cluster = namedtuple('Cluster', ('groups', 'identical', 'similarity', 'shared', 'savings'))
+Cluster.__doc__ = '''Groups with identical or similar rule sets.
+
+* groups: names of groups in the cluster
+* identical: whether all groups have exactly the same rules
+* similarity: Jaccard similarity of all rule sets (intersection / union)
+* shared: amount of rules common to all groups
+* savings: amount of rules saved if shared rules were moved to one group
+'''
+
+
+def _rule_key(group_name, rule):
+    '''Canonical form of rule, references to the group itself are normalized.'''
+    d = rule.to_dict()
+    if d['group'] == group_name:
+        d['group'] = ('self',)
+    return tuple(d.values())
+
+
+def rule_sets(groups):
+    '''Return mapping of group name to canonical rule set.'''
+    return {group.name: frozenset(_rule_key(group.name, rule) for rule in group.rules)
+            for group in groups}
+
+
+def _stable_hash(key):
+    '''Hash of rule key which (unlike hash()) does not change between processes.'''
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') & _MASK
+
+
+def _minhash(keys, coefficients):
+    hashes = [_stable_hash(key) for key in keys]
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in coefficients)
+
+
+def find_duplicates(groups, similarity=0.8, num_perm=64, bands=16, seed=0):
+    '''Find clusters of groups with identical or similar rule sets.
+
+    Identical rule sets are found by hashing. Similar ones using MinHash
+    signatures with locality-sensitive hashing (num_perm hash functions
+    split into bands); candidates are then verified using exact Jaccard
+    similarity. Most similar candidates are merged first and a cluster only
+    grows while similarity of all its groups stays above the threshold.
+    Groups without rules are ignored.
+    '''
+    if num_perm % bands:
+        raise ValueError('num_perm must be divisible by bands')
+    sets = rule_sets(groups)
+
+    # Identical rule sets
+    identical = {}
+    for name, rules in sets.items():
+        if rules:
+            identical.setdefault(rules, []).append(name)
+    representatives = list(identical)
+
+    # Similar rule sets, only representatives of identical ones are compared
+    cluster_of = list(range(len(representatives)))
+    # Cluster index -> (representative indexes, shared rules, all rules)
+    merged = {i: ([i], rules, rules) for i, rules in enumerate(representatives)}
+
+    if similarity < 1:
+        rnd = random.Random(seed)
+        coefficients = [(rnd.randrange(1, _PRIME), rnd.randrange(0, _PRIME))
+                        for _ in range(num_perm)]
+        rows = num_perm // bands
+        buckets = {}
+        for i, rules in enumerate(representatives):
+            signature = _minhash(rules, coefficients)
+            for band in range(bands):
+                key = (band, signature[band * rows:(band + 1) * rows])
+                buckets.setdefault(key, []).append(i)
+
+        candidates = {}
+        for members in buckets.values():
+            for pos, i in enumerate(members):
+                for j in members[pos + 1:]:
+                    if (i, j) not in candidates:
+                        a, b = representatives[i], representatives[j]
+                        candidates[i, j] = len(a & b) / len(a | b)
+
+        for (i, j), value in sorted(candidates.items(), key=lambda item: (-item[1], item[0])):
+            if value < similarity:
+                break
+            ci, cj = cluster_of[i], cluster_of[j]
+            if ci == cj:
+                continue
+            members_i, shared_i, union_i = merged[ci]
+            members_j, shared_j, union_j = merged[cj]
+            shared, union = shared_i & shared_j, union_i | union_j
+            # Check against whole cluster, similar pairs may chain dissimilar groups
+            if not shared or len(shared) / len(union) < similarity:
+                continue
+            for k in members_j:
+                cluster_of[k] = ci
+            merged[ci] = (members_i + members_j, shared, union)
+            del merged[cj]
+
+    clusters = []
+    for members, shared, union in merged.values():
+        names = tuple(sorted(name for i in members for name in identical[representatives[i]]))
+        if len(names) < 2:
+            continue
+        clusters.append(Cluster(groups=names,
+                                identical=len(members) == 1,
+                                similarity=len(shared) / len(union),
+                                shared=len(shared),
+                                savings=(len(names) - 1) * len(shared)))
+    clusters.sort(key=lambda cluster: (-cluster.savings, cluster.groups))
+    return clusters
+
+
+def report_duplicates(clusters):
+    '''Log clusters found by find_duplicates().'''
+    total = sum(cluster.savings for cluster in clusters)
+    logger.info(f'{len(clusters):d} clusters of duplicate groups,'
+                f' consolidation would save {total:d} rules:')
+    for cluster in clusters:
+        kind = 'identical' if cluster.identical else f'{cluster.similarity:.0%} similar'
+        logger.info(f'  - {len(cluster.groups):d} {kind} groups sharing {cluster.shared:d} rules'
+                    f' (saves {cluster.savings:d}): {", ".join(cluster.groups)}')
+
+
+# Expected amount of ports in every group when estimating costs
+DEFAULT_GROUP_PORTS = 10
+
+# IP version of addresses matching EtherType of rule
+_VERSIONS = {EtherType.IPv4: 4, EtherType.IPv6: 6}
+
+Cost = namedtuple('Cost', ('group', 'rules', 'references', 'fanout', 'flows', 'fanout_flows',
+                           'conntrack'))
+Cost.__doc__ = '''Estimated datapath cost of a group.
+
+* group: name of the group
+* rules: amount of rules
+* references: amount of rules referencing other groups (or the group itself)
+* fanout: amount of groups (including the group itself) with rules referencing the group
+* flows: flows programmed for every port bound with the group
+* fanout_flows: flows updated in referencing groups when port joins the group
+* conntrack: connection tracking entries if every allowed peer connected once
+'''
+
+
+def port_masks(port_min, port_max):
+    '''Return amount of value/mask pairs needed to match port range.'''
+    if port_min is None:
+        return 1
+    if port_max is None:
+        port_max = port_min
+    count = 0
+    start = port_min
+    while start <= port_max:
+        # Largest aligned block starting at start which fits into range
+        size = start & -start if start else 1 << 16
+        while start + size - 1 > port_max:
+            size >>= 1
+        start += size
+        count += 1
+    return count
+
+
+def estimate_costs(groups, address_groups=(), group_ports=DEFAULT_GROUP_PORTS):
+    '''Estimate datapath cost of groups, most expensive first.
+
+    Every rule needs one flow per port mask (see port_masks()) and remote
+    peer. Peers are group_ports ports of referenced group, addresses of
+    address group (of rule's EtherType), or single CIDR. Groups referenced by many others are
+    expensive as well, because flows of all referencing rules change when
+    port joins or leaves them. Groups are ranked by sum of both.
+    '''
+    addresses = {group.name: Counter(addr.version for addr in group.addresses)
+                 for group in address_groups}
+    fanout = {}
+    fanout_flows = {}
+    costs = {}
+    for group in groups:
+        references = 0
+        flows = 0
+        conntrack = 0
+        for rule in group.rules:
+            masks = port_masks(rule.port_min, rule.port_max)
+            if rule.group is not None:
+                references += 1
+                peers = group_ports
+                fanout_flows[rule.group] = fanout_flows.get(rule.group, 0) + masks
+                fanout.setdefault(rule.group, set()).add(group.name)
+            elif rule.address_group in addresses:
+                peers = addresses[rule.address_group][_VERSIONS[rule.ethertype]]
+            else:
+                peers = 1
+            flows += masks * peers
+            conntrack += peers
+        costs[group.name] = (len(group.rules), references, flows, conntrack)
+
+    result = [Cost(group=name,
+                   rules=rules,
+                   references=references,
+                   fanout=len(fanout.get(name, ())),
+                   flows=flows,
+                   fanout_flows=fanout_flows.get(name, 0),
+                   conntrack=conntrack)
+              for name, (rules, references, flows, conntrack) in costs.items()]
+    result.sort(key=lambda cost: (-(cost.flows + cost.fanout_flows), cost.group))
+    return result
+
+
+def report_costs(costs, limit=None):
+    '''Log costs estimated by estimate_costs(), at most limit groups.'''
+    flows = sum(cost.flows for cost in costs)
+    logger.info(f'{len(costs):d} groups need {flows:d} flows per port in total,'
+                f' most expensive:')
+    for cost in costs[:limit]:
+        logger.info(f'  - {cost.group}: {cost.flows:d} flows per port'
+                    f' ({cost.rules:d} rules, {cost.references:d} group-referencing rules),'
+                    f' {cost.fanout_flows:d} flows in {cost.fanout:d} referencing groups,'
+                    f' {cost.conntrack:d} conntrack entries')
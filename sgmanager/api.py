@@ -0,0 +1,87 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+'''Reentrant API for running many reconciliations in one process.
+
+Nothing here keeps state between calls, every reconciliation uses its own
+SGManager. Logging is not configured, that is up to the caller.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from .changeset import compute_changes
+from .manager import SGManager, resolve_references
+from .utils import validate_groups
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+
+
+def load_config(config, fmt=None):
+    '''Load local configuration, return (groups, address groups).'''
+    manager = SGManager()
+    manager.load_local_groups(config, fmt)
+    return list(manager.local), list(manager.local_address_groups)
+
+
+def load_remote(connection, names=None, address_groups=False):
+    '''Load remote state, return (groups, address groups).
+
+    References of rules are resolved to names.
+    '''
+    manager = SGManager(connection)
+    manager.load_remote_groups(names, address_groups=address_groups)
+    return list(manager.remote), list(manager.remote_address_groups)
+
+
+def plan(config, remote, remote_address_groups=(), remove=True, exclude_tag=None,
+         columnar=False, fmt=None):
+    '''Return ChangeSet turning remote groups into the ones from configuration.
+
+    Remote groups (and address groups) are not modified, references of their
+    rules might be either resolved names or IDs.
+    '''
+    local, local_address_groups = load_config(config, fmt)
+    validate_groups(local, local_address_groups)
+    return compute_changes(local, resolve_references(remote, remote_address_groups),
+                           remove=remove, exclude_tag=exclude_tag, columnar=columnar,
+                           local_address_groups=local_address_groups,
+                           remote_address_groups=remote_address_groups)
+
+
+class Executor:
+    '''Run reconciliations concurrently in a pool of threads.
+
+    connection (openstack.connection.Connection) is shared by all
+    reconciliations, so its authenticated session and HTTP connection pool
+    are reused. Reconciliation of another project can be given its own
+    connection, e.g. from connection.connect_as_project().
+    '''
+    def __init__(self, connection=None, workers=DEFAULT_WORKERS):
+        self.connection = connection
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def reconcile(self, config, connection=None, dry_run=True, threshold=None, remove=True,
+                  exclude_tag=None, check_quota=True, reporter=None):
+        '''Update remote groups with configuration, return applied ChangeSet.'''
+        manager = SGManager(connection if connection is not None else self.connection)
+        manager.load_local_groups(config)
+        manager.load_remote_groups()
+        return manager.update_remote_groups(dry_run=dry_run, threshold=threshold,
+                                            remove=remove, exclude_tag=exclude_tag,
+                                            reporter=reporter, check_quota=check_quota)
+
+    def submit(self, config, **kwargs):
+        '''Schedule reconcile(), return Future of its ChangeSet.'''
+        return self._executor.submit(self.reconcile, config, **kwargs)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
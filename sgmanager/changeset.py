@@ -0,0 +1,236 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+from collections import namedtuple
+
+from .exceptions import ThresholdException
+
+_ChangeSet = namedtuple('_ChangeSet', (
+    'groups_added',
+    'groups_updated',
+    'groups_removed',
+    'groups_excluded',
+    'rules_added',
+    'rules_removed',
+    'address_groups_added',
+    'address_groups_updated',
+    'address_groups_removed',
+    'changes',
+    'unchanged',
+))
+
+
+class ChangeSet(_ChangeSet):
+    '''Immutable result of comparing local groups with remote ones.
+
+    * groups_added: local groups which do not exist remotely
+    * groups_updated: (remote group, local group) with different description
+    * groups_removed: remote groups which do not exist locally
+    * groups_excluded: remote groups skipped because of their tag
+    * rules_added: (group name, local rule) to be created
+    * rules_removed: (group name, remote rule) to be deleted
+    * address_groups_added: local address groups which do not exist remotely
+    * address_groups_updated: (remote address group, added addresses, removed addresses)
+    * address_groups_removed: remote address groups which do not exist locally
+    * changes/unchanged: amount of changed/unchanged groups and rules
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def merge(cls, changesets):
+        '''Merge change sets of disjoint sets of groups into one.'''
+        fields = {field: [] for field in cls._fields}
+        for changeset in changesets:
+            for field, value in zip(cls._fields, changeset):
+                fields[field].append(value)
+        return cls(**{field: (sum(values) if field in ('changes', 'unchanged')
+                              else tuple(item for value in values for item in value))
+                      for field, values in fields.items()})
+
+    def __bool__(self):
+        return self.changes > 0 or len(self.groups_updated) > 0
+
+    @property
+    def excluded(self):
+        return len(self.groups_excluded)
+
+    @property
+    def percentage(self):
+        '''Amount of changes in percents.'''
+        total = self.changes + self.unchanged
+        return self.changes / total * 100 if total else 0.0
+
+    def check_threshold(self, threshold):
+        '''Raise ThresholdException if there are more changes than allowed.'''
+        if threshold is None:
+            return
+        if self.percentage > threshold:
+            raise ThresholdException(f'Amount of changes is {self.percentage:f}%'
+                                     f' which is more than allowed ({threshold:f}%)')
+
+    def check_quotas(self, quotas, removals_first=False):
+        '''Raise QuotaException if changes do not fit into quotas (see sgmanager.quota).'''
+        from .quota import check_quotas
+        return check_quotas(self, quotas, removals_first)
+
+    def report(self, exclude_tag=None, reporter=None):
+        '''Report excluded groups and changes to be made (using TextReporter by default).'''
+        if reporter is None:
+            from .report import TextReporter
+            reporter = TextReporter()
+        reporter.report(self, exclude_tag)
+
+
+def compute_changes(local, remote, remove=True, exclude_tag=None, columnar=False,
+                    local_address_groups=(), remote_address_groups=()):
+    '''Compare local groups with remote ones in a single pass.
+
+    Neither groups nor their rules are modified. Remote groups are expected
+    to have references to other groups resolved to names (as done by
+    SGManager.remote). The default group is never changed.
+
+    Address groups are compared by their addresses. Every address counts
+    as a single change. Address groups are excluded by tag as well, but they
+    are not reported as excluded.
+
+    With columnar, rules are compared as NumPy integer tables (requires numpy).
+    '''
+    lgroups = {group.name: group for group in local if group.name != 'default'}
+    rgroups = {group.name: group for group in remote if group.name != 'default'}
+
+    def is_excluded(group):
+        return exclude_tag is not None and exclude_tag in (group.tags or ())
+
+    changes = 0
+    unchanged = 0
+    groups_added = []
+    groups_updated = []
+    groups_removed = []
+    groups_excluded = []
+    rules_added = []
+    rules_removed = []
+    # Rules of common groups, compared at once in columnar mode
+    lpairs = []
+    rpairs = []
+
+    # Added groups, all their rules are added as well
+    for name, lgroup in lgroups.items():
+        if name in rgroups:
+            continue
+        groups_added.append(lgroup)
+        changes += 1
+        for rule in lgroup.rules:
+            rules_added.append((name, rule))
+            changes += 1
+
+    # Changed groups
+    for name, rgroup in rgroups.items():
+        lgroup = lgroups.get(name)
+        if lgroup is None:
+            continue
+        unchanged += 1
+
+        # Exclude taged security groups
+        if is_excluded(rgroup):
+            groups_excluded.append(rgroup)
+            continue
+
+        if rgroup.description != lgroup.description:
+            # XXX: https://review.openstack.org/596609
+            # groups_updated.append((rgroup, lgroup))
+            pass
+
+        if columnar:
+            lpairs.extend((name, rule) for rule in lgroup.rules)
+            rpairs.extend((name, rule) for rule in rgroup.rules)
+            continue
+
+        rrules = set(rgroup.rules)
+        lrules = set(lgroup.rules)
+        for rule in lgroup.rules:
+            if rule in rrules:
+                unchanged += 1
+            else:
+                rules_added.append((name, rule))
+                changes += 1
+        for rule in rgroup.rules:
+            if rule in lrules:
+                continue
+            if remove:
+                rules_removed.append((name, rule))
+                changes += 1
+            else:
+                unchanged += 1
+
+    if columnar:
+        from .columnar import RuleTable, diff
+        names = {}
+        added, removed, common = diff(RuleTable(lpairs, names), RuleTable(rpairs, names))
+        rules_added.extend(added)
+        changes += len(added)
+        if remove:
+            rules_removed.extend(removed)
+            changes += len(removed)
+        else:
+            unchanged += len(removed)
+        unchanged += common
+
+    # Removed groups
+    for name, rgroup in rgroups.items():
+        if name in lgroups:
+            continue
+        if is_excluded(rgroup):
+            groups_excluded.append(rgroup)
+            continue
+        if remove:
+            if rgroup._project is None:
+                continue
+            groups_removed.append(rgroup)
+            changes += len(rgroup.rules) + 1
+        else:
+            unchanged += len(rgroup.rules) + 1
+
+    # Address groups
+    address_groups_added = []
+    address_groups_updated = []
+    address_groups_removed = []
+    lagroups = {group.name: group for group in local_address_groups}
+    ragroups = {group.name: group for group in remote_address_groups}
+    for name, lgroup in lagroups.items():
+        rgroup = ragroups.get(name)
+        if rgroup is None:
+            address_groups_added.append(lgroup)
+            changes += len(lgroup.addresses) + 1
+            continue
+        if is_excluded(rgroup):
+            unchanged += len(rgroup.addresses) + 1
+            continue
+        added = lgroup.addresses - rgroup.addresses
+        removed = rgroup.addresses - lgroup.addresses
+        unchanged += len(lgroup.addresses & rgroup.addresses) + 1
+        if not remove:
+            unchanged += len(removed)
+            removed = frozenset()
+        if added or removed:
+            address_groups_updated.append((rgroup, added, removed))
+            changes += len(added) + len(removed)
+    for name, rgroup in ragroups.items():
+        if name in lagroups:
+            continue
+        if remove and rgroup._project is not None and not is_excluded(rgroup):
+            address_groups_removed.append(rgroup)
+            changes += len(rgroup.addresses) + 1
+        else:
+            unchanged += len(rgroup.addresses) + 1
+
+    return ChangeSet(groups_added=tuple(groups_added),
+                     groups_updated=tuple(groups_updated),
+                     groups_removed=tuple(groups_removed),
+                     groups_excluded=tuple(groups_excluded),
+                     rules_added=tuple(rules_added),
+                     rules_removed=tuple(rules_removed),
+                     address_groups_added=tuple(address_groups_added),
+                     address_groups_updated=tuple(address_groups_updated),
+                     address_groups_removed=tuple(address_groups_removed),
+                     changes=changes,
+                     unchanged=unchanged)
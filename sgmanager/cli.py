@@ -9,16 +9,25 @@ import sys
 import openstack
 from openstack.config import OpenStackConfig
 
+from .analysis import (DEFAULT_GROUP_PORTS, estimate_costs, find_duplicates, report_costs,
+                       report_duplicates)
 from .manager import SGManager
-from .utils import dump_groups, validate_groups
+from .pipeline import DEFAULT_WORKERS, pipelined_update
+from .query import Index
+from .report import DEFAULT_LIMIT, JsonlReporter, TextReporter
+from .utils import FORMATS, dump_groups, git_changed_files, validate_groups
 
-logging.basicConfig(level=logging.ERROR)
 LOGGER = logging.getLogger('sgmanager')
-LOGGER_HANDLER = logging.StreamHandler()
-LOGGER_FORMATTER = logging.Formatter("%(asctime)s %(levelname)s: %(message)s")
-LOGGER_HANDLER.setFormatter(LOGGER_FORMATTER)
-LOGGER.addHandler(LOGGER_HANDLER)
-LOGGER.setLevel(logging.INFO)
+
+
+def setup_logging(debug=False):
+    '''Configure logging for command line use, library users configure their own.'''
+    logging.basicConfig(level=logging.ERROR)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
+    LOGGER.addHandler(handler)
+    LOGGER.setLevel(logging.DEBUG if debug else logging.INFO)
+
 
 def main(argv=None):
     if argv is None:
@@ -42,6 +51,17 @@ def main(argv=None):
         'dump',
         help='Dump configuration',
     )
+    cmd_dump.add_argument(
+        '--format',
+        choices=FORMATS,
+        default='yaml',
+        help='Output format (default: yaml)',
+    )
+    cmd_dump.add_argument(
+        '--address-groups',
+        action='store_true',
+        help='Dump remote address groups as well',
+    )
     cmd_dump.add_argument(
         'config',
         nargs='?',
@@ -52,15 +72,28 @@ def main(argv=None):
         if args.config is None:
             # Dump remote groups
             manager.connection = openstack.connect(config=args)
-            manager.load_remote_groups()
+            manager.load_remote_groups(address_groups=args.address_groups)
             groups = manager.remote
+            address_groups = manager.remote_address_groups
         else:
             # Dump local groups
             manager.load_local_groups(args.config)
             groups = manager.local
-            validate_groups(groups)
+            address_groups = manager.local_address_groups
+            validate_groups(groups, address_groups)
 
-        print(dump_groups(groups, default_flow_style=False, width=-1))
+        if args.format == 'yaml':
+            dump_groups(groups, sys.stdout, address_groups=address_groups,
+                        default_flow_style=False, width=-1)
+            # Keep trailing empty line which print() used to add
+            print()
+        elif args.format == 'json':
+            dump_groups(groups, sys.stdout, format='json', address_groups=address_groups,
+                        indent=2)
+            print()
+        else:
+            dump_groups(groups, sys.stdout.buffer, format='msgpack',
+                        address_groups=address_groups)
 
     cmd_update = cmd.add_parser(
         'update',
@@ -77,7 +110,7 @@ def main(argv=None):
         type=int,
         default=15,
         help='Maximum threshold to us for adding/removing'
-             ' groups/rules in a percentage')
+             ' groups/rules in a percentage (negative value disables it)')
     cmd_update.add_argument(
         '--no-remove',
         dest='remove',
@@ -92,19 +125,245 @@ def main(argv=None):
         dest='exclude_tag',
         default='orchestrator=terraform',
         help='Exclude taged security groups from removing and updating. Default tag is "orchestrator=terraform"')
+    cmd_update.add_argument(
+        '--columnar',
+        action='store_true',
+        help='Compare rules using vectorized tables (requires numpy)')
+    cmd_update.add_argument(
+        '--no-check-quota',
+        action='store_false',
+        dest='check_quota',
+        help='Do not fail before making any change if changes would not fit into project quotas')
+    cmd_update.add_argument(
+        '--removals-first',
+        action='store_true',
+        help='Remove rules and groups before creating new ones, which keeps quota usage'
+             ' lower but may deny some traffic during update')
+    cmd_update.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Load local and remote groups concurrently and apply changes of every group'
+             ' as soon as they are known (right away if threshold is disabled with -t -1)')
+    cmd_update.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=f'Amount of concurrent API calls with --pipeline (default: {DEFAULT_WORKERS})')
+    cmd_update.add_argument(
+        '--report-format',
+        choices=('text', 'jsonl'),
+        default='text',
+        help='Format of report of changes. jsonl writes one JSON record per change'
+             ' to --report-file and logs only summary')
+    cmd_update.add_argument(
+        '--report-file',
+        type=pathlib.Path,
+        help='File to write jsonl report to (default: standard output)')
+    cmd_update.add_argument(
+        '--report-limit',
+        type=int,
+        default=DEFAULT_LIMIT,
+        help='Maximum amount of changes (or groups, if there are more changes) logged'
+             f' in detail, negative value means unlimited (default: {DEFAULT_LIMIT})')
+    changed = cmd_update.add_mutually_exclusive_group()
+    changed.add_argument(
+        '--changed-since',
+        metavar='REF',
+        help='Update only groups defined in files changed since git REF'
+             ' (and groups they reference). Groups are never removed in this mode')
+    changed.add_argument(
+        '--changed-files',
+        metavar='FILE',
+        nargs='+',
+        type=pathlib.Path,
+        help='Update only groups defined in given files'
+             ' (and groups they reference). Groups are never removed in this mode')
 
     def update(manager, args):
+        if args.report_format == 'jsonl':
+            if args.report_file is None:
+                return update_reported(manager, args, JsonlReporter(sys.stdout))
+            # File is created only when it is going to be written
+            with open(args.report_file, 'w') as report_file:
+                return update_reported(manager, args, JsonlReporter(report_file))
+        limit = args.report_limit if args.report_limit >= 0 else None
+        return update_reported(manager, args, TextReporter(limit))
+
+    def update_reported(manager, args, reporter):
+        threshold = args.threshold if args.threshold >= 0 else None
         manager.connection = openstack.connect(config=args)
+        if args.pipeline:
+            if args.changed_since is not None or args.changed_files is not None:
+                parser.error('--pipeline can not be combined with --changed-*')
+            if args.removals_first:
+                parser.error('--pipeline can not be combined with --removals-first')
+            pipelined_update(manager, args.config,
+                             dry_run=args.dry_run,
+                             threshold=threshold,
+                             remove=args.remove,
+                             exclude_tag=args.exclude_tag,
+                             workers=args.workers,
+                             reporter=reporter,
+                             check_quota=args.check_quota,
+                             columnar=args.columnar)
+            return
+
         manager.load_local_groups(args.config)
-        manager.load_remote_groups()
+        if args.changed_since is not None or args.changed_files is not None:
+            if args.changed_since is not None:
+                files = git_changed_files(args.changed_since, args.config.resolve().parent)
+            else:
+                files = args.changed_files
+            names = manager.changed_groups(files)
+            LOGGER.info(f'{len(names):d} groups affected by changed files')
+            if not names:
+                return
+            manager.select_local_groups(names)
+            manager.load_remote_groups(names)
+        else:
+            manager.load_remote_groups()
         manager.update_remote_groups(dry_run=args.dry_run,
-                                     threshold=args.threshold,
+                                     threshold=threshold,
                                      remove=args.remove,
-                                     exclude_tag=args.exclude_tag)
+                                     exclude_tag=args.exclude_tag,
+                                     columnar=args.columnar,
+                                     reporter=reporter,
+                                     check_quota=args.check_quota,
+                                     removals_first=args.removals_first)
+
+    cmd_query = cmd.add_parser(
+        'query',
+        help='Query rules of local or remote groups',
+    )
+    cmd_query.add_argument(
+        '-p', '--protocol',
+        help='Rules allowing given protocol',
+    )
+    cmd_query.add_argument(
+        '--port',
+        help='Rules allowing given port or port range (MIN-MAX)',
+    )
+    cmd_query.add_argument(
+        '--cidr',
+        help='Rules allowing whole given network',
+    )
+    cmd_query.add_argument(
+        '-r', '--references',
+        metavar='GROUP',
+        help='Rules referencing given group',
+    )
+    cmd_query.add_argument(
+        '-i', '--index',
+        type=pathlib.Path,
+        help='Use index previously stored by --save-index instead of loading groups',
+    )
+    cmd_query.add_argument(
+        '--save-index',
+        type=pathlib.Path,
+        help='Store index to file for later reuse',
+    )
+    cmd_query.add_argument(
+        'config',
+        nargs='?',
+        type=pathlib.Path,
+    )
+
+    def query(manager, args):
+        if args.index is not None:
+            index = Index.load(args.index)
+        else:
+            if args.config is None:
+                manager.connection = openstack.connect(config=args)
+                manager.load_remote_groups()
+                groups, address_groups = manager.remote, manager.remote_address_groups
+            else:
+                manager.load_local_groups(args.config)
+                groups, address_groups = manager.local, manager.local_address_groups
+            index = Index(groups, address_groups)
+        if args.save_index is not None:
+            index.save(args.save_index)
+
+        port_min = port_max = None
+        if args.port is not None:
+            port_min, _, port_max = args.port.partition('-')
+            port_min = int(port_min)
+            port_max = int(port_max) if port_max else port_min
+
+        for group_name, rule in index.query(protocol=args.protocol,
+                                            port_min=port_min,
+                                            port_max=port_max,
+                                            cidr=args.cidr,
+                                            references=args.references):
+            print(f'{group_name}: {rule!r}')
+
+    cmd_duplicates = cmd.add_parser(
+        'duplicates',
+        help='Report local or remote groups with identical or similar rules',
+    )
+    cmd_duplicates.add_argument(
+        '-s', '--similarity',
+        type=float,
+        default=0.8,
+        help='Minimal Jaccard similarity of rule sets (default: 0.8, 1 means identical only)',
+    )
+    cmd_duplicates.add_argument(
+        'config',
+        nargs='?',
+        type=pathlib.Path,
+    )
+
+    def duplicates(manager, args):
+        if args.config is None:
+            manager.connection = openstack.connect(config=args)
+            manager.load_remote_groups()
+            groups = manager.remote
+        else:
+            manager.load_local_groups(args.config)
+            groups = manager.local
+        report_duplicates(find_duplicates(groups, similarity=args.similarity))
+
+    cmd_cost = cmd.add_parser(
+        'cost',
+        help='Estimate datapath (flows and conntrack) cost of local or remote groups',
+    )
+    cmd_cost.add_argument(
+        '-p', '--group-ports',
+        type=int,
+        default=DEFAULT_GROUP_PORTS,
+        help=f'Expected amount of ports in every group (default: {DEFAULT_GROUP_PORTS})',
+    )
+    cmd_cost.add_argument(
+        '--address-groups',
+        action='store_true',
+        help='Load remote address groups to count their addresses',
+    )
+    cmd_cost.add_argument(
+        '-n', '--limit',
+        type=int,
+        default=20,
+        help='Amount of most expensive groups to list (default: 20, negative means all)',
+    )
+    cmd_cost.add_argument(
+        'config',
+        nargs='?',
+        type=pathlib.Path,
+    )
+
+    def cost(manager, args):
+        if args.config is None:
+            manager.connection = openstack.connect(config=args)
+            manager.load_remote_groups(address_groups=args.address_groups)
+            groups = manager.remote
+            address_groups = manager.remote_address_groups
+        else:
+            manager.load_local_groups(args.config)
+            groups = manager.local
+            address_groups = manager.local_address_groups
+        report_costs(estimate_costs(groups, address_groups, group_ports=args.group_ports),
+                     limit=args.limit if args.limit >= 0 else None)
 
-    args = parser.parse_args()
-    if args.debug:
-        LOGGER.setLevel(logging.DEBUG)
+    args = parser.parse_args(argv)
+    setup_logging(args.debug)
 
     manager = SGManager()
     locals()[args.command](manager, args)
@@ -0,0 +1,88 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+import numpy as np
+
+from .rule import Direction, EtherType, Protocol
+
+# Column layout of encoded rule
+COLUMNS = ('group', 'direction', 'ethertype', 'protocol', 'port_min', 'port_max',
+           'addr_hi', 'addr_lo', 'prefixlen', 'ref', 'address_ref')
+
+_DIRECTIONS = {value: i for i, value in enumerate(Direction)}
+_ETHERTYPES = {value: i for i, value in enumerate(EtherType)}
+_PROTOCOLS = {value: i for i, value in enumerate(Protocol)}
+_MASK64 = (1 << 64) - 1
+
+
+def _signed(value):
+    # Values are only compared, so store unsigned 64 bits as signed
+    return value - (1 << 64) if value >> 63 else value
+
+
+class RuleTable:
+    '''Rules of many groups encoded as fixed-width integer columns.
+
+    Group names (owning and referenced, including address groups) are mapped to integers using
+    shared names mapping, so that tables encoded with the same mapping can
+    be compared. Missing values are encoded as -1.
+    '''
+    def __init__(self, pairs, names):
+        self.pairs = list(pairs)
+
+        def name_index(name):
+            return names.setdefault(name, len(names))
+
+        rows = []
+        for group_name, rule in self.pairs:
+            if rule.cidr is not None:
+                addr = int(rule.cidr.network_address)
+                addr_hi, addr_lo = _signed(addr >> 64), _signed(addr & _MASK64)
+                prefixlen = rule.cidr.prefixlen
+            else:
+                addr_hi = addr_lo = 0
+                prefixlen = -1
+            rows.append((
+                name_index(group_name),
+                _DIRECTIONS[rule.direction],
+                _ETHERTYPES[rule.ethertype],
+                _PROTOCOLS[rule.protocol] if rule.protocol is not None else -1,
+                rule.port_min if rule.port_min is not None else -1,
+                rule.port_max if rule.port_max is not None else -1,
+                addr_hi,
+                addr_lo,
+                prefixlen,
+                name_index(rule.group) if rule.group is not None else -1,
+                (name_index(('address_group', rule.address_group))
+                 if rule.address_group is not None else -1),
+            ))
+        self.rows = np.array(rows, dtype=np.int64).reshape(len(rows), len(COLUMNS))
+
+    def __len__(self):
+        return len(self.pairs)
+
+
+def diff(local, remote):
+    '''Compute difference of two rule tables using sort-merge.
+
+    Rows are expected to be unique within each table. Returns tuple of
+    (added, removed, common count) where added/removed are lists of
+    (group name, rule) in the order of the input tables.
+    '''
+    nlocal = len(local)
+    rows = np.concatenate((local.rows, remote.rows))
+    if not len(rows):
+        return [], [], 0
+
+    # lexsort uses the last key as primary one
+    order = np.lexsort(rows.T[::-1])
+    srows = rows[order]
+    same = np.zeros(len(srows) + 1, dtype=bool)
+    same[1:-1] = (srows[1:] == srows[:-1]).all(axis=1)
+    unique = ~(same[:-1] | same[1:])
+
+    different = np.sort(order[unique])
+    split = np.searchsorted(different, nlocal)
+    added = [local.pairs[i] for i in different[:split]]
+    removed = [remote.pairs[i - nlocal] for i in different[split:]]
+    return added, removed, nlocal - len(added)
@@ -8,3 +8,7 @@ class InvalidConfiguration(Exception):
 
 class ThresholdException(Exception):
     pass
+
+
+class QuotaException(Exception):
+    pass
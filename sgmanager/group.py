@@ -20,6 +20,8 @@ class Group(Base):
         self.rules = OrderedSet(rules)
         self._project = None
         self._id = None
+        self._source = None
+        self._includes = frozenset()
 
     def to_dict(self, user=False):
         '''Convert object to dictionary, mangling options for best user view if requested.'''
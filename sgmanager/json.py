@@ -0,0 +1,28 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+import ipaddress
+import json
+
+
+def default(value):
+    '''Convert few custom types to JSON-serializable ones.'''
+    from .utils import Base
+    if isinstance(value, Base):
+        return value.to_dict(True)
+    if isinstance(value, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+        return str(value)
+    raise TypeError(f'Object of type {type(value)} is not JSON serializable')
+
+
+def load(stream, **kwargs):
+    '''Load JSON from stream.'''
+    return json.load(stream, **kwargs)
+
+
+def dump(data, stream=None, **kwargs):
+    '''Dump JSON to stream, supporting few custom types.'''
+    kwargs.setdefault('default', default)
+    if stream is None:
+        return json.dumps(data, **kwargs)
+    json.dump(data, stream, **kwargs)
@@ -2,17 +2,76 @@
 # Copyright © 2018, GoodData Corporation. All rights reserved.
 
 import logging
+import pathlib
 
 from orderedset import OrderedSet
 
-from .exceptions import InvalidConfiguration, ThresholdException
+from .address_group import AddressGroup
+from .changeset import compute_changes
+from .exceptions import InvalidConfiguration
 from .group import Group
 from .rule import Rule
-from .utils import validate_groups
-from .yaml import load
+from .utils import load_document, validate_groups
 
 logger = logging.getLogger(__name__)
 
+# Amount of group names (or IDs) requested from OpenStack at once
+REMOTE_FILTER_CHUNK = 100
+# Only fields which are used by Group.from_remote() and Rule.from_remote()
+GROUP_FIELDS = ('id', 'name', 'description', 'tags', 'project_id')
+RULE_FIELDS = ('id', 'security_group_id', 'direction', 'ethertype', 'protocol',
+               'port_range_min', 'port_range_max', 'remote_ip_prefix', 'remote_group_id',
+               'remote_address_group_id')
+
+
+def _replace(obj, **changes):
+    '''Return shallow copy of group or rule with changed attributes (keeping IDs).'''
+    new = obj.__class__.__new__(obj.__class__)
+    new.__dict__.update(obj.__dict__)
+    for key, value in changes.items():
+        setattr(new, key, value)
+    return new
+
+
+def resolve_references(groups, address_groups=()):
+    '''Return remote groups with IDs of referenced (address) groups replaced by names.
+
+    Given groups and rules are not modified, groups with resolved rules are copies.
+    References to groups which are not loaded (e.g. subset) are kept as IDs.
+    '''
+    gmap = {group._id: group.name for group in groups if group._id is not None}
+    amap = {group._id: group.name for group in address_groups if group._id is not None}
+
+    def resolve(rule):
+        changes = {}
+        if rule.group in gmap:
+            changes['group'] = gmap[rule.group]
+        if rule.address_group in amap:
+            changes['address_group'] = amap[rule.address_group]
+        return _replace(rule, **changes) if changes else rule
+
+    resolved = []
+    for group in groups:
+        rules = [resolve(rule) for rule in group.rules]
+        if any(new is not old for new, old in zip(rules, group.rules)):
+            group = _replace(group, rules=OrderedSet(rules))
+        resolved.append(group)
+    return resolved
+
+
+def expand_ethertypes(rules, address_groups):
+    '''Yield rules, expanding those which reference address group without EtherType.
+
+    Such rule is replaced by one rule per EtherType of addresses in the address group.
+    '''
+    for rule in rules:
+        agroup = address_groups.get(rule.address_group)
+        if agroup is None or rule._ethertype is not None or not agroup.ethertypes:
+            yield rule
+            continue
+        for ethertype in agroup.ethertypes:
+            yield _replace(rule, ethertype=ethertype)
+
 
 class SGManager:
     '''The Manager.'''
@@ -20,6 +79,8 @@ class SGManager:
         self.connection = connection
         self._local = None
         self._remote = None
+        self._local_address_groups = []
+        self._remote_address_groups = []
 
     @property
     def connection(self):
@@ -49,31 +110,97 @@ class SGManager:
 
     @remote.setter
     def remote(self, groups):
-        self._remote = OrderedSet(self._process_remote_groups(groups))
-
-    @staticmethod
-    def _process_remote_groups(groups):
-        gmap = {group._id: group.name for group in groups}
-        for group in groups:
-            for rule in group.rules:
-                # XXX: this is hacky because we rely on the fact that
-                #      it has been resolved if value looks like a group name
-                if rule.group is not None and rule.group not in gmap.values():
-                    rule.group = gmap[rule.group]
-        return groups
-
-    def load_remote_groups(self):
-        '''Load groups from OpenStack.'''
-        conf = self.connection.list_security_groups()
-
-        self.remote = [Group.from_remote(**info)
+        self._remote = OrderedSet(resolve_references(groups, self._remote_address_groups))
+
+    @property
+    def local_address_groups(self):
+        return self._local_address_groups
+
+    @local_address_groups.setter
+    def local_address_groups(self, groups):
+        self._local_address_groups = list(groups)
+
+    @property
+    def remote_address_groups(self):
+        return self._remote_address_groups
+
+    @remote_address_groups.setter
+    def remote_address_groups(self, groups):
+        self._remote_address_groups = list(groups)
+
+    def _neutron_groups(self):
+        '''Whether security groups are provided by Neutron (not by Nova).'''
+        return (self.connection.has_service('network') and
+                getattr(self.connection, 'secgroup_source', 'neutron') == 'neutron')
+
+    def load_remote_address_groups(self):
+        '''Load address groups of current project from OpenStack.'''
+        project_id = self.connection.current_project_id
+        # Do not rely on server-side filtering, shared groups are listed as well
+        self.remote_address_groups = [
+            AddressGroup.from_remote(**info)
+            for info in self.connection.network.address_groups(project_id=project_id)
+            if info.get('project_id') == project_id]
+        return self.remote_address_groups
+
+    def load_remote_groups(self, names=None, address_groups=None):
+        '''Load groups from OpenStack, optionally only those with given names.
+
+        Groups are listed without embedded rules, rules are listed separately
+        (ingress only) and joined to groups by ID. Nova security groups
+        (without Neutron) are listed as a whole.
+
+        Address groups are loaded as well if requested. By default only
+        when local configuration defines some, since not every cloud
+        supports them.
+        '''
+        if address_groups is None:
+            address_groups = bool(self.local_address_groups)
+        if address_groups:
+            self.load_remote_address_groups()
+
+        if not self._neutron_groups():
+            # Neither fields nor rules can be listed separately
+            conf = list(self.connection.list_security_groups())
+            if names is not None:
+                wanted = set(names)
+                conf = [info for info in conf if info['name'] in wanted]
+            self.remote = [Group.from_remote(**info) for info in conf]
+            return self.remote
+
+        fields = list(GROUP_FIELDS)
+        if names is None:
+            conf = list(self.connection.list_security_groups(filters={'fields': fields}))
+        else:
+            names = sorted(names)
+            conf = []
+            for i in range(0, len(names), REMOTE_FILTER_CHUNK):
+                conf.extend(self.connection.list_security_groups(
+                    filters={'name': names[i:i + REMOTE_FILTER_CHUNK], 'fields': fields}))
+            # Do not rely on server-side filtering being supported
+            wanted = set(names)
+            conf = [info for info in conf if info['name'] in wanted]
+
+        rules = {info['id']: [] for info in conf}
+        if names is None:
+            queries = [{}]
+        else:
+            ids = sorted(rules)
+            queries = [{'security_group_id': ids[i:i + REMOTE_FILTER_CHUNK]}
+                       for i in range(0, len(ids), REMOTE_FILTER_CHUNK)]
+        for query in queries:
+            for rinfo in self.connection.network.security_group_rules(
+                    direction='ingress', fields=list(RULE_FIELDS), **query):
+                if rinfo['security_group_id'] in rules:
+                    rules[rinfo['security_group_id']].append(rinfo)
+
+        self.remote = [Group.from_remote(**{**info, 'security_group_rules': rules[info['id']]})
                        for info in conf]
         return self.remote
 
-    def load_local_groups(self, config):
-        '''Load groups from local configuration file.'''
-        with open(config, 'r') as f:
-            conf = load(f)
+    def load_local_groups(self, config, fmt=None):
+        '''Load groups from local configuration file (YAML, JSON or msgpack).'''
+        conf = load_document(config, fmt)
 
         groups = []
         if not isinstance(conf, dict):
@@ -136,187 +263,238 @@ class SGManager:
         if version != 1:
             raise InvalidConfiguration(f'Document version {version!r} is not supported')
         data = pop_with_type(conf, 'data', list)
+        address_groups = (pop_with_type(conf, 'address_groups', list)
+                          if 'address_groups' in conf else [])
 
         if conf:
             raise InvalidConfiguration(f'Extra keys: {", ".join(conf.keys())}')
 
+        agroups = []
+        for item in address_groups:
+            name, info = next(iter(item.items()))
+            if len(item.items()) > 1:
+                raise InvalidConfiguration(
+                    f'Syntax error, for address group named {name!r}. Missing indent?')
+            if isinstance(info, list):
+                # Shorthand: name: [addresses]
+                info = {'addresses': info}
+            agroups.append(AddressGroup.from_local(**{'name': name, **info}))
+        self.local_address_groups = agroups
+        agroups = {group.name: group for group in agroups}
+
+        config_source = pathlib.Path(config).resolve()
         for item in data:
             name, info = next(iter(item.items()))
             if len(item.items()) > 1:
                 raise InvalidConfiguration(
                     f'Syntax error, for item named {name!r}. Missing indent?')
 
-            groups.append(Group.from_local(**{'name': name, **info}))
+            group = Group.from_local(**{'name': name, **info})
+            group.rules = OrderedSet(expand_ethertypes(group.rules, agroups))
+            # Remember where group came from (might be included file)
+            group._source = (getattr(info, 'source', None) or
+                             getattr(item, 'source', None) or
+                             config_source)
+            group._includes = frozenset().union(*(getattr(obj, 'includes', ())
+                                                  for obj in (item, info)))
+            groups.append(group)
 
         self.local = groups
         return self.local
 
-    def update_remote_groups(self, dry_run=True, threshold=None, remove=True, exclude_tag=None):
-        '''Update remote configuration with the local one.'''
-        # Copy those so that we can modify them even with dry-run
-        local = OrderedSet(self.local)
-        remote = OrderedSet(self.remote)
-
-        validate_groups(local)
-
-        def parse_groups(groups, remote):
-            if remote:
-                self._process_remote_groups(groups)
-            groups = {group.name: group for group in groups if group.name != 'default'}
-            keys = OrderedSet(groups.keys())
-            return groups, keys
-
-        lgroups, lkeys = parse_groups(local, False)
-        rgroups, rkeys = parse_groups(remote, True)
-
-        changes = 0
-        unchanged = 0
-        excluded = 0
-        groups_added = OrderedSet()
-        groups_updated = OrderedSet()
-        groups_removed = OrderedSet()
-        groups_excluded = OrderedSet()
-        rules_added = OrderedSet()
-        rules_removed = OrderedSet()
+    def changed_groups(self, files):
+        '''Return names of local groups defined in given files (or including them).
+
+        Groups referenced from rules of those groups are included as well
+        (recursively) so that references can be resolved.
+        '''
+        files = set(pathlib.Path(f).resolve() for f in files)
+        lgroups = {group.name: group for group in self.local}
+
+        names = set()
+        pending = [name for name, group in lgroups.items()
+                   if group._source in files or group._includes & files]
+        while pending:
+            name = pending.pop()
+            if name in names or name not in lgroups:
+                continue
+            names.add(name)
+            pending.extend(rule.group for rule in lgroups[name].rules
+                           if rule.group is not None)
+        return names
+
+    def select_local_groups(self, names):
+        '''Keep only local groups with given names.'''
+        self.local = [group for group in self.local if group.name in names]
+        return self.local
+
+    def compute_changes(self, remove=True, exclude_tag=None, columnar=False):
+        '''Compare local groups with remote ones, see changeset.compute_changes().'''
+        validate_groups(self.local, self.local_address_groups)
+        return compute_changes(self.local, self.remote, remove=remove,
+                               exclude_tag=exclude_tag, columnar=columnar,
+                               local_address_groups=self.local_address_groups,
+                               remote_address_groups=self.remote_address_groups)
+
+    def load_quotas(self):
+        '''Return network quotas of current project with their usage.
+
+        Returns None if groups are not provided by Neutron (no network quotas).
+        '''
+        if not self._neutron_groups():
+            logger.info('Security groups are not provided by Neutron, quotas are not checked')
+            return None
+        return self.connection.get_network_quotas(self.connection.current_project_id,
+                                                  details=True)
+
+    def update_remote_groups(self, dry_run=True, threshold=None, remove=True, exclude_tag=None,
+                             columnar=False, reporter=None, check_quota=True,
+                             removals_first=False):
+        '''Update remote configuration with the local one.
+
+        With columnar, rules are compared as NumPy integer tables (requires numpy).
+        Changes are reported using reporter (see sgmanager.report).
+        With check_quota (default), project quotas are fetched and QuotaException
+        is raised before any change is made if changes would not fit into them.
+        With removals_first, rules and groups are removed before new ones are created.
+        Returns ChangeSet which was (or would be with dry_run) applied.
+        '''
+        changeset = self.compute_changes(remove=remove, exclude_tag=exclude_tag,
+                                         columnar=columnar)
+        changeset.report(exclude_tag, reporter)
+        if not changeset:
+            return changeset
+
+        changeset.check_threshold(threshold)
+        if check_quota:
+            quotas = self.load_quotas()
+            if quotas is not None:
+                changeset.check_quotas(quotas, removals_first)
+
+        if not dry_run:
+            self.apply_changes(changeset, removals_first)
+        return changeset
+
+    def apply_changes(self, changeset, removals_first=False):
+        '''Apply changes to OpenStack and update remote groups accordingly.
+
+        By default everything is created before anything is removed, so that
+        no traffic is denied during update. With removals_first, removals are
+        done first instead, which keeps usage of quotas lower.
+        '''
+        remote = list(self.remote)
+        rgroups = {group.name: group for group in remote}
+        agroups = {group.name: group for group in self.remote_address_groups}
+
+        if removals_first:
+            self._remove(changeset, remote, rgroups, agroups)
+
+        # Address groups have to exist before rules use them
+        self._apply_address_groups(changeset, agroups)
 
         # Added groups
-        for group in (lgroups[name] for name in lkeys - rkeys):
-            grp = Group(group.name, group.description)
-            groups_added.add(grp)
-            rgroups[group.name] = grp
-            rkeys.add(grp.name)
-            changes += 1
-
-        # Changed groups
-        for rgroup, lgroup in ((rgroups[name], lgroups[name])
-                               for name in rkeys & lkeys):
-            if rgroup not in groups_added:
-                unchanged += 1
-
-            # Exclude taged security groups
-            if exclude_tag is not None and exclude_tag in rgroup.tags:
-                excluded += 1
-                groups_excluded.add(rgroup)
-                continue
+        for group in changeset.groups_added:
+            rgroup = self._create_group(group)
+            remote.append(rgroup)
+            rgroups[rgroup.name] = rgroup
 
-            if rgroup.description != lgroup.description:
-                # XXX: https://review.openstack.org/596609
-                # groups_updated.add((rgroup, lgroup))
-                pass
-
-            # FIXME: when comparing using OrderedSet, added rules part contains
-            #        all elements rather than different ones.
-            lrules, rrules = set(lgroup.rules), set(rgroup.rules)
-
-            if rrules != lrules:
-                # Added rules
-                for rule in lrules - rrules:
-                    rules_added.add((rgroup.name, rule))
-                    changes += 1
-
-                # Removed rules
-                for rule in rrules - lrules:
-                    if remove:
-                        rules_removed.add((rgroup.name, rule))
-                        changes += 1
-                    else:
-                        unchanged += 1
-            unchanged += len(rrules & lrules)
+        # Updated groups
+        for rgroup, lgroup in changeset.groups_updated:
+            self._update_group(rgroup, lgroup)
 
-        # Removed groups
-        for group in (rgroups[name] for name in rkeys - lkeys):
-            if exclude_tag is not None and exclude_tag in group.tags:
-                excluded += 1
-                groups_excluded.add(group)
-                continue
-            if remove:
-                if group._project is None:
-                    continue
-                groups_removed.add(group)
-                changes += len(group.rules) + 1
-            else:
-                unchanged += len(group.rules) + 1
-
-        if excluded > 0:
-            logger.info(f'{excluded:d} excluded changes. Security groups taged as {exclude_tag!r}:')
-            for group in groups_excluded:
-                logger.info(f'  - Excluded group {group.name!r}')
-
-        if changes == 0 and not groups_updated:
-            return
+        # Added rules
+        for group_name, rule in changeset.rules_added:
+            self._create_rule(rgroups, group_name, rule, agroups)
 
-        # Report result
-        logger.info(f'{changes:d} changes to be made:')
-        for group in groups_added:
-            logger.info(f'  - Create group {group.name!r}')
-        for rgroup, lgroup in groups_updated:
-            logger.info(f'  - Update description for {rgroup.name!r}:'
-                        f' {rgroup.description!r} → {lgroup.description!r}')
-        for group_name, rule in rules_added:
-            logger.info(f'  - Create {rule!r} in group {group_name!r}')
-        for group_name, rule in rules_removed:
-            logger.info(f'  - Remove {rule!r} from group {group_name!r}')
-        for group in groups_removed:
-            logger.info(f'  - Remove group {group.name!r} with {len(group.rules)} rules')
-
-        if threshold is not None:
-            changes_percentage = changes / (unchanged + changes) * 100
-            if changes_percentage > threshold:
-                raise ThresholdException(f'Amount of changes is {changes_percentage:f}%'
-                                         f' which is more than allowed ({threshold:f}%)')
-
-        if dry_run:
-            return
+        if not removals_first:
+            self._remove(changeset, remote, rgroups, agroups)
 
-        # We've modified 'remote', so copy it again
-        remote = OrderedSet(self.remote)
-        rgroups, rkeys = parse_groups(remote, True)
+        # Resolves references of newly created rules
+        self.remote_address_groups = agroups.values()
+        self.remote = remote
 
-        # Added groups
-        for group in groups_added:
-            ginfo = self.connection.create_security_group(
-                name=group.name,
-                description=group.description)
-            remote.add(Group.from_remote(**ginfo))
-        rgroups, rkeys = parse_groups(remote, True)
+    def _remove(self, changeset, remote, rgroups, agroups):
+        # Removed rules
+        for group_name, rule in changeset.rules_removed:
+            self._delete_rule(rgroups, group_name, rule)
 
-        # Updated groups
-        for rgroup, lgroup in groups_updated:
-            self.connection.update_security_group(
-                name_or_id=rgroup._id,
-                description=lgroup.description)
-            # Updating group should not change its ID
-            rgroup.description = lgroup.description
+        # Removed groups
+        for group in changeset.groups_removed:
+            self._delete_group(group)
+            remote.remove(group)
+
+        # Removed address groups, once no rule uses them
+        self._apply_address_groups(changeset, agroups, removed=True)
+
+    def _apply_address_groups(self, changeset, agroups, removed=False):
+        if removed:
+            for group in changeset.address_groups_removed:
+                self.connection.network.delete_address_group(group._id)
+                del agroups[group.name]
+            return
 
-        # Added rules
-        for group_name, rule in rules_added:
-            rgroup = rgroups[group_name]
-            cidr = str(rule.cidr) if rule.cidr is not None else None
-            group_id = rgroups[rule.group]._id if rule.group is not None else None
-            protocol = rule.protocol.value if rule.protocol is not None else None
-            rinfo = self.connection.create_security_group_rule(
-                secgroup_name_or_id=rgroup._id,
+        for group in changeset.address_groups_added:
+            info = self.connection.network.create_address_group(
+                name=group.name,
+                description=group.description,
+                addresses=sorted(str(addr) for addr in group.addresses))
+            agroups[group.name] = AddressGroup.from_remote(**info)
+
+        for rgroup, added, removed in changeset.address_groups_updated:
+            if added:
+                self.connection.network.add_addresses_to_address_group(
+                    rgroup._id, sorted(str(addr) for addr in added))
+            if removed:
+                self.connection.network.remove_addresses_from_address_group(
+                    rgroup._id, sorted(str(addr) for addr in removed))
+            rgroup.addresses = (rgroup.addresses | added) - removed
+
+    def _create_group(self, group):
+        ginfo = self.connection.create_security_group(
+            name=group.name,
+            description=group.description)
+        return Group.from_remote(**ginfo)
+
+    def _update_group(self, rgroup, lgroup):
+        self.connection.update_security_group(
+            name_or_id=rgroup._id,
+            description=lgroup.description)
+        # Updating group should not change its ID
+        rgroup.description = lgroup.description
+
+    def _create_rule(self, rgroups, group_name, rule, agroups=None):
+        rgroup = rgroups[group_name]
+        cidr = str(rule.cidr) if rule.cidr is not None else None
+        group_id = rgroups[rule.group]._id if rule.group is not None else None
+        protocol = rule.protocol.value if rule.protocol is not None else None
+        if rule.address_group is not None:
+            # Not supported by cloud layer
+            rinfo = self.connection.network.create_security_group_rule(
+                security_group_id=rgroup._id,
                 port_range_min=rule.port_min,
                 port_range_max=rule.port_max,
                 protocol=protocol,
-                remote_ip_prefix=cidr,
-                remote_group_id=group_id,
+                remote_address_group_id=agroups[rule.address_group]._id,
                 direction=rule.direction.value,
-                ethertype=rule.ethertype.value)
+                ether_type=rule.ethertype.value)
             rgroup.rules.add(Rule.from_remote(**rinfo))
-
-        if remove:
-            # Removed rules
-            for group_name, rule in rules_removed:
-                rgroup = rgroups[group_name]
-                self.connection.delete_security_group_rule(
-                    rule_id=rule._id)
-                rgroup.rules.remove(rule)
-
-            # Removed groups
-            for group in groups_removed:
-                self.connection.delete_security_group(
-                    name_or_id=group._id)
-                remote.remove(group)
-
-        self.remote = remote
+            return
+        rinfo = self.connection.create_security_group_rule(
+            secgroup_name_or_id=rgroup._id,
+            port_range_min=rule.port_min,
+            port_range_max=rule.port_max,
+            protocol=protocol,
+            remote_ip_prefix=cidr,
+            remote_group_id=group_id,
+            direction=rule.direction.value,
+            ethertype=rule.ethertype.value)
+        rgroup.rules.add(Rule.from_remote(**rinfo))
+
+    def _delete_rule(self, rgroups, group_name, rule):
+        self.connection.delete_security_group_rule(
+            rule_id=rule._id)
+        rgroups[group_name].rules.remove(rule)
+
+    def _delete_group(self, group):
+        self.connection.delete_security_group(
+            name_or_id=group._id)
@@ -0,0 +1,20 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+import msgpack
+
+from .json import default
+
+
+def load(stream, **kwargs):
+    '''Load msgpack from binary stream.'''
+    kwargs.setdefault('raw', False)
+    return msgpack.unpack(stream, **kwargs)
+
+
+def dump(data, stream=None, **kwargs):
+    '''Dump msgpack to binary stream, supporting few custom types.'''
+    kwargs.setdefault('default', default)
+    if stream is None:
+        return msgpack.packb(data, **kwargs)
+    msgpack.pack(data, stream, **kwargs)
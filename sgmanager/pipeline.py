@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+
+from .changeset import ChangeSet, compute_changes
+from .utils import validate_groups
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+
+
+def _group_pairs(local, remote):
+    '''Yield (local group, remote group) pairs, either of them might be None.'''
+    lgroups = {group.name: group for group in local if group.name != 'default'}
+    rgroups = {group.name: group for group in remote if group.name != 'default'}
+    for name, lgroup in lgroups.items():
+        yield lgroup, rgroups.get(name)
+    for name, rgroup in rgroups.items():
+        if name not in lgroups:
+            yield None, rgroup
+
+
+def _raise_first(futures):
+    done, _ = wait(futures)
+    for future in done:
+        future.result()
+
+
+def pipelined_update(manager, config, dry_run=True, threshold=None, remove=True,
+                     exclude_tag=None, workers=DEFAULT_WORKERS, reporter=None,
+                     check_quota=True, columnar=False):
+    '''Update remote groups overlapping loading, comparing and applying.
+
+    Local configuration is parsed while remote groups are fetched. Groups
+    are then compared one by one and changes of every group are applied
+    as soon as they are known, in parallel with comparing remaining groups.
+
+    Without threshold and check_quota, nothing waits for whole comparison.
+    With threshold, whole comparison (which is done in memory) has to finish
+    and pass the check before first change is applied; applying is still
+    parallel. The same applies to check_quota (default), quotas are fetched
+    along with groups.
+    With columnar, rules of every group are compared as NumPy tables.
+
+    Returns merged ChangeSet.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        local_future = executor.submit(manager.load_local_groups, config)
+        remote_future = executor.submit(manager.load_remote_groups)
+        if check_quota:
+            quotas_future = executor.submit(manager.load_quotas)
+        local = local_future.result()
+        remote = remote_future.result()
+        validate_groups(local, manager.local_address_groups)
+        if manager.local_address_groups and not manager.remote_address_groups:
+            # It was not known whether they are needed when loading started
+            manager.load_remote_address_groups()
+            manager.remote = remote
+            remote = manager.remote
+        address_changeset = compute_changes([], [], remove=remove,
+                                            local_address_groups=manager.local_address_groups,
+                                            remote_address_groups=manager.remote_address_groups)
+
+        def diff(lgroup, rgroup):
+            return compute_changes([lgroup] if lgroup is not None else [],
+                                   [rgroup] if rgroup is not None else [],
+                                   remove=remove, exclude_tag=exclude_tag, columnar=columnar)
+
+        changesets = (diff(lgroup, rgroup) for lgroup, rgroup in _group_pairs(local, remote))
+        if threshold is not None or check_quota or dry_run:
+            changesets = list(changesets)
+            changeset = ChangeSet.merge([address_changeset] + changesets)
+            changeset.report(exclude_tag, reporter)
+            if not changeset:
+                return changeset
+            changeset.check_threshold(threshold)
+            quotas = quotas_future.result() if check_quota else None
+            if quotas is not None:
+                changeset.check_quotas(quotas)
+            if dry_run:
+                return changeset
+
+        # Groups have to exist before rules can reference them
+        agroups = {group.name: group for group in manager.remote_address_groups}
+        manager._apply_address_groups(address_changeset, agroups)
+        rgroups = {group.name: group for group in remote}
+        added = [lgroup for lgroup, rgroup in _group_pairs(local, remote) if rgroup is None]
+        for rgroup in executor.map(manager._create_group, added):
+            rgroups[rgroup.name] = rgroup
+
+        def apply_rules(changeset):
+            # Every task touches rules of single group only
+            for group_name, rule in changeset.rules_added:
+                manager._create_rule(rgroups, group_name, rule, agroups)
+            for group_name, rule in changeset.rules_removed:
+                manager._delete_rule(rgroups, group_name, rule)
+
+        applied = [address_changeset]
+        futures = []
+        for changeset in changesets:
+            applied.append(changeset)
+            if changeset.rules_added or changeset.rules_removed:
+                futures.append(executor.submit(apply_rules, changeset))
+        _raise_first(futures)
+
+        changeset = ChangeSet.merge(applied)
+        if threshold is None and not check_quota:
+            # Changes were not known upfront
+            changeset.report(exclude_tag, reporter)
+
+        _raise_first([executor.submit(manager._delete_group, group)
+                      for group in changeset.groups_removed])
+        manager._apply_address_groups(address_changeset, agroups, removed=True)
+
+    removed = set(id(group) for group in changeset.groups_removed)
+    # Resolves references of newly created rules
+    manager.remote_address_groups = agroups.values()
+    manager.remote = [group for group in rgroups.values() if id(group) not in removed]
+    return changeset
@@ -0,0 +1,228 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+import bisect
+import ipaddress
+import json
+import logging
+
+from .rule import Rule, _network
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 4
+
+# IP version of addresses matching EtherType of rule
+_VERSIONS = {'IPv4': 4, 'IPv6': 6}
+
+
+def _build_tree(ranges):
+    '''Build centered interval tree from (start, stop, idx) tuples.
+
+    Node is (center, ranges containing center sorted by start,
+    the same sorted by stop descending, left subtree, right subtree).
+    '''
+    if not ranges:
+        return None
+    points = sorted(point for start, stop, _ in ranges for point in (start, stop))
+    center = points[len(points) // 2]
+    left = [item for item in ranges if item[1] < center]
+    right = [item for item in ranges if item[0] > center]
+    here = [item for item in ranges if item[0] <= center <= item[1]]
+    return (center,
+            sorted(here, key=lambda item: item[0]),
+            sorted(here, key=lambda item: -item[1]),
+            _build_tree(left),
+            _build_tree(right))
+
+
+def _stab(node, point):
+    '''Yield ranges of tree containing point.'''
+    while node is not None:
+        center, by_start, by_stop, left, right = node
+        if point < center:
+            for item in by_start:
+                if item[0] > point:
+                    break
+                yield item
+            node = left
+        elif point > center:
+            for item in by_stop:
+                if item[1] < point:
+                    break
+                yield item
+            node = right
+        else:
+            yield from by_start
+            return
+
+
+class Index:
+    '''Index over rules of groups for fast lookups.
+
+    * CIDRs are indexed by (IP version, prefix length, prefix), so finding
+      all networks containing some network means one lookup per prefix
+      length present in the index.
+    * Single ports are indexed directly, port ranges are kept in interval
+      tree, so only ranges containing queried port are visited.
+    * Referenced groups have reverse index pointing to rules.
+    * Rules referencing address group are indexed by every address
+      of the group (of the same EtherType) as if it was their CIDR.
+    '''
+    def __init__(self, groups=(), address_groups=()):
+        # Rows are plain tuples so that index is cheap to persist
+        self.rows = []
+        self.groups = set()
+        self.address_groups = {}
+        self._protocols = {}
+        self._prefixes = {}
+        self._lengths = {4: [], 6: []}
+        self._any_port = set()
+        self._ports = {}
+        self._ranges = []
+        self._tree = None
+        self._references = {}
+        self._address_references = {}
+        for group in address_groups:
+            self.add_address_group(group)
+        for group in groups:
+            self.add_group(group)
+
+    def add_group(self, group):
+        self.groups.add(group.name)
+        for rule in group.rules:
+            protocol = rule.protocol.value if rule.protocol is not None else None
+            cidr = str(rule.cidr) if rule.cidr is not None else None
+            self._add_row((group.name, rule.direction.value, rule.ethertype.value, protocol,
+                           rule.port_min, rule.port_max, cidr, rule.group, rule.address_group))
+
+    def add_address_group(self, group):
+        '''Add addresses of address group, also to rules already referencing it.'''
+        self._add_addresses(group.name, sorted(str(addr) for addr in group.addresses))
+
+    def _add_addresses(self, name, addresses):
+        self.address_groups[name] = addresses
+        for idx in self._address_references.get(name, ()):
+            self._add_address_group_row(idx)
+
+    def _add_address_group_row(self, idx):
+        _, _, ethertype, _, _, _, _, _, address_group = self.rows[idx]
+        for addr in self.address_groups.get(address_group, ()):
+            net = _network(addr)
+            if net.version == _VERSIONS[ethertype]:
+                self._add_network(net, idx)
+
+    def _add_network(self, net, idx):
+        key = (net.version, net.prefixlen, int(net.network_address) >> (net.max_prefixlen -
+                                                                        net.prefixlen))
+        self._prefixes.setdefault(key, set()).add(idx)
+        if net.prefixlen not in self._lengths[net.version]:
+            bisect.insort(self._lengths[net.version], net.prefixlen)
+
+    def _add_row(self, row):
+        idx = len(self.rows)
+        self.rows.append(row)
+        _, _, _, protocol, port_min, port_max, cidr, group, address_group = row
+
+        self._protocols.setdefault(protocol, set()).add(idx)
+
+        if cidr is not None:
+            self._add_network(_network(cidr), idx)
+        if address_group is not None:
+            self._address_references.setdefault(address_group, set()).add(idx)
+            self._add_address_group_row(idx)
+
+        if port_min is None:
+            self._any_port.add(idx)
+        elif port_min == port_max:
+            self._ports.setdefault(port_min, set()).add(idx)
+        else:
+            self._ranges.append((port_min, port_max, idx))
+            # Rebuilt on next lookup
+            self._tree = None
+
+        if group is not None:
+            self._references.setdefault(group, set()).add(idx)
+
+    def by_cidr(self, cidr):
+        '''Return rules allowing whole given network.'''
+        net = ipaddress.ip_network(cidr, False)
+        addr = int(net.network_address)
+        result = set()
+        for length in self._lengths[net.version]:
+            if length > net.prefixlen:
+                break
+            key = (net.version, length, addr >> (net.max_prefixlen - length))
+            result.update(self._prefixes.get(key, ()))
+        return result
+
+    def by_port(self, port_min, port_max=None):
+        '''Return rules allowing whole given port range.'''
+        if port_max is None:
+            port_max = port_min
+        result = set(self._any_port)
+        if port_min == port_max:
+            result.update(self._ports.get(port_min, ()))
+        if self._tree is None and self._ranges:
+            self._tree = _build_tree(self._ranges)
+        result.update(idx for _, stop, idx in _stab(self._tree, port_min) if stop >= port_max)
+        return result
+
+    def by_protocol(self, protocol):
+        '''Return rules allowing given protocol.'''
+        return self._protocols.get(protocol, set()) | self._protocols.get(None, set())
+
+    def by_reference(self, group_name):
+        '''Return rules referencing given group.'''
+        return set(self._references.get(group_name, ()))
+
+    def query(self, protocol=None, port_min=None, port_max=None, cidr=None, references=None):
+        '''Return matching rules as list of (group name, rule) tuples.'''
+        candidates = []
+        if protocol is not None:
+            candidates.append(self.by_protocol(protocol))
+        if port_min is not None:
+            candidates.append(self.by_port(port_min, port_max))
+        if cidr is not None:
+            candidates.append(self.by_cidr(cidr))
+        if references is not None:
+            candidates.append(self.by_reference(references))
+
+        if candidates:
+            candidates.sort(key=len)
+            result = candidates[0].intersection(*candidates[1:])
+        else:
+            result = range(len(self.rows))
+
+        return [(self.rows[idx][0], self._rule(idx)) for idx in sorted(result)]
+
+    def _rule(self, idx):
+        (_, direction, ethertype, protocol, port_min, port_max, cidr, group,
+         address_group) = self.rows[idx]
+        return Rule(direction=direction, ethertype=ethertype, protocol=protocol,
+                    port_min=port_min, port_max=port_max, cidr=cidr, group=group,
+                    address_group=address_group)
+
+    def save(self, path):
+        '''Persist index to JSON file, lookup tables are rebuilt by load().'''
+        with open(path, 'w') as f:
+            json.dump({'version': INDEX_VERSION,
+                       'groups': sorted(self.groups),
+                       'address_groups': self.address_groups,
+                       'rows': self.rows}, f)
+
+    @classmethod
+    def load(cls, path):
+        '''Load index persisted by save().'''
+        with open(path, 'r') as f:
+            state = json.load(f)
+        version = state.get('version') if isinstance(state, dict) else None
+        if version != INDEX_VERSION:
+            raise ValueError(f'Index version {version!r} is not supported')
+        index = cls()
+        index.groups.update(state['groups'])
+        for name, addresses in state['address_groups'].items():
+            index._add_addresses(name, addresses)
+        for row in state['rows']:
+            index._add_row(tuple(row))
+        return index
@@ -0,0 +1,111 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+from collections import namedtuple
+import logging
+
+from .exceptions import QuotaException
+
+logger = logging.getLogger(__name__)
+
+# Neutron creates default egress rules (IPv4 and IPv6) with every new group
+DEFAULT_EGRESS_RULES = 2
+# Quotas which have to be known, address groups have no quota in Neutron
+REQUIRED_QUOTAS = ('security_group', 'security_group_rule')
+# Attribute names of openstack.network.v2.quota.Quota
+_ATTRIBUTES = {'security_groups': 'security_group',
+               'security_group_rules': 'security_group_rule',
+               'address_groups': 'address_group'}
+
+Usage = namedtuple('Usage', ('current', 'added', 'removed', 'peak', 'final', 'limit'))
+Usage.__doc__ = '''Predicted usage of single quota.
+
+* current: used (and reserved) amount before changes
+* added/removed: amount of created/deleted resources
+* peak: usage reached by the last creation
+* final: usage after all changes
+* limit: quota, negative means unlimited
+'''
+
+
+def normalize_quotas(quotas):
+    '''Return detailed quotas as mapping with Neutron resource names.
+
+    quotas is either openstack.network.v2.quota.QuotaDetails (as returned by
+    get_network_quotas(details=True)) or plain mapping. Raise QuotaException
+    if some of REQUIRED_QUOTAS is missing.
+    '''
+    if hasattr(quotas, 'to_dict'):
+        quotas = quotas.to_dict(original_names=True)
+    normalized = {_ATTRIBUTES.get(key, key): value for key, value in quotas.items()
+                  if isinstance(value, dict)}
+    missing = [resource for resource in REQUIRED_QUOTAS if resource not in normalized]
+    if missing:
+        raise QuotaException(f'Quota details are not known for: {", ".join(missing)}')
+    return normalized
+
+
+def predict_usage(changeset, quotas, removals_first=False, egress_rules=DEFAULT_EGRESS_RULES):
+    '''Predict usage of quotas during and after applying changes.
+
+    quotas is detailed network quota mapping as returned by normalize_quotas():
+    resource → {'limit', 'used', 'reserved'}.
+
+    Returns mapping resource → Usage. Every created group is expected to come
+    with egress_rules default rules. Rules of removed groups which are not
+    known (egress ones) are not counted as released.
+    '''
+    groups_added = len(changeset.groups_added)
+    rules_added = len(changeset.rules_added) + egress_rules * groups_added
+    rules_removed = (len(changeset.rules_removed) +
+                     sum(len(group.rules) for group in changeset.groups_removed))
+    deltas = {'security_group': (groups_added, len(changeset.groups_removed)),
+              'security_group_rule': (rules_added, rules_removed),
+              'address_group': (len(changeset.address_groups_added),
+                                len(changeset.address_groups_removed))}
+
+    usage = {}
+    for resource, (added, removed) in deltas.items():
+        info = quotas.get(resource)
+        if info is None:
+            continue
+        current = info.get('used', 0) + info.get('reserved', 0)
+        final = current + added - removed
+        if removals_first:
+            peak = final
+        else:
+            # Everything is created before anything is removed
+            peak = current + added
+        usage[resource] = Usage(current, added, removed, peak, final, info['limit'])
+    return usage
+
+
+def check_quotas(changeset, quotas, removals_first=False, egress_rules=DEFAULT_EGRESS_RULES):
+    '''Raise QuotaException if changes do not fit into quotas, return predicted usage.
+
+    quotas are anything accepted by normalize_quotas(). If changes fit only
+    when removals are done first, exception says so. Usage which is already
+    over quota is fine as long as nothing is created.
+    '''
+    usage = predict_usage(changeset, normalize_quotas(quotas), removals_first, egress_rules)
+    limited = {resource: item
+               for resource, item in usage.items()
+               if item.added and item.limit is not None and item.limit >= 0}
+    for resource, item in usage.items():
+        logger.debug(f'Quota {resource!r}: {item.current} used, +{item.added}/-{item.removed},'
+                     f' {item.peak} at peak, {item.final} in the end, limit {item.limit}')
+
+    final = [(resource, item) for resource, item in limited.items() if item.final > item.limit]
+    if final:
+        raise QuotaException('Changes do not fit into quota: ' +
+                             ', '.join(f'{resource} would be {item.final} (limit {item.limit})'
+                                       for resource, item in final))
+    peak = [(resource, item) for resource, item in limited.items() if item.peak > item.limit]
+    if peak:
+        message = ('Quota would be exceeded during update: ' +
+                   ', '.join(f'{resource} would reach {item.peak} (limit {item.limit})'
+                             for resource, item in peak))
+        if not removals_first:
+            message += '; applying removals first would keep it within quota'
+        raise QuotaException(message)
+    return usage
@@ -0,0 +1,174 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+from collections import OrderedDict
+import itertools
+import logging
+
+from . import json
+
+logger = logging.getLogger(__name__)
+
+# Maximum amount of lines with details of changes
+DEFAULT_LIMIT = 50
+
+
+def _addresses(addresses):
+    return sorted(addresses, key=lambda net: (net.version, net))
+
+
+def iter_records(changeset):
+    '''Yield change records (dictionaries) in order in which changes are applied.'''
+    for group in changeset.groups_excluded:
+        yield {'action': 'exclude', 'kind': 'group', 'group': group.name}
+    for group in changeset.address_groups_added:
+        yield {'action': 'create', 'kind': 'address_group', 'address_group': group.name,
+               'addresses': _addresses(group.addresses)}
+    for group, added, removed in changeset.address_groups_updated:
+        for addr in _addresses(added):
+            yield {'action': 'create', 'kind': 'address', 'address_group': group.name,
+                   'address': addr}
+        for addr in _addresses(removed):
+            yield {'action': 'remove', 'kind': 'address', 'address_group': group.name,
+                   'address': addr}
+    for group in changeset.groups_added:
+        yield {'action': 'create', 'kind': 'group', 'group': group.name,
+               'description': group.description}
+    for rgroup, lgroup in changeset.groups_updated:
+        yield {'action': 'update', 'kind': 'group', 'group': rgroup.name, 'id': rgroup._id,
+               'description': lgroup.description}
+    for group_name, rule in changeset.rules_added:
+        yield {'action': 'create', 'kind': 'rule', 'group': group_name, 'rule': rule}
+    for group_name, rule in changeset.rules_removed:
+        yield {'action': 'remove', 'kind': 'rule', 'group': group_name, 'id': rule._id,
+               'rule': rule}
+    for group in changeset.groups_removed:
+        yield {'action': 'remove', 'kind': 'group', 'group': group.name, 'id': group._id,
+               'rules': len(group.rules)}
+    for group in changeset.address_groups_removed:
+        yield {'action': 'remove', 'kind': 'address_group', 'address_group': group.name,
+               'id': group._id}
+
+
+class TextReporter:
+    '''Log changes for humans.
+
+    If there are at most limit changes, every one of them is logged.
+    Otherwise changes are aggregated per group and at most limit groups
+    are listed. Nothing is formatted if INFO messages are not logged.
+    '''
+    def __init__(self, limit=DEFAULT_LIMIT):
+        self.limit = limit
+
+    def _lines(self, lines, total, what):
+        # Arguments are formatted by logging only when it is really emitted
+        for line in itertools.islice(lines, self.limit):
+            logger.info(*line)
+        if self.limit is not None and total > self.limit:
+            logger.info('  ... and %d more %s', total - self.limit, what)
+
+    def report(self, changeset, exclude_tag=None):
+        if not logger.isEnabledFor(logging.INFO):
+            return
+
+        if changeset.excluded > 0:
+            logger.info('%d excluded changes. Security groups taged as %r:',
+                        changeset.excluded, exclude_tag)
+            self._lines((('  - Excluded group %r', group.name)
+                         for group in changeset.groups_excluded),
+                        changeset.excluded, 'excluded groups')
+
+        if not changeset:
+            return
+
+        logger.info('%d changes to be made:', changeset.changes)
+        details = (len(changeset.address_groups_added) + len(changeset.groups_added) +
+                   len(changeset.groups_updated) + len(changeset.rules_added) +
+                   len(changeset.rules_removed) + len(changeset.groups_removed) +
+                   len(changeset.address_groups_removed) +
+                   sum(len(added) + len(removed)
+                       for _, added, removed in changeset.address_groups_updated))
+        if self.limit is None or details <= self.limit:
+            self._lines(self._details(changeset), details, 'changes')
+        else:
+            summary = self._summary(changeset)
+            self._lines(summary.values(), len(summary), 'groups')
+
+    @staticmethod
+    def _details(changeset):
+        for group in changeset.address_groups_added:
+            yield ('  - Create address group %r with %d addresses',
+                   group.name, len(group.addresses))
+        for group, added, removed in changeset.address_groups_updated:
+            for addr in _addresses(added):
+                yield '  - Add %s to address group %r', addr, group.name
+            for addr in _addresses(removed):
+                yield '  - Remove %s from address group %r', addr, group.name
+        for group in changeset.groups_added:
+            yield '  - Create group %r', group.name
+        for rgroup, lgroup in changeset.groups_updated:
+            yield ('  - Update description for %r: %r → %r',
+                   rgroup.name, rgroup.description, lgroup.description)
+        for group_name, rule in changeset.rules_added:
+            yield '  - Create %r in group %r', rule, group_name
+        for group_name, rule in changeset.rules_removed:
+            yield '  - Remove %r from group %r', rule, group_name
+        for group in changeset.groups_removed:
+            yield '  - Remove group %r with %d rules', group.name, len(group.rules)
+        for group in changeset.address_groups_removed:
+            yield '  - Remove address group %r', group.name
+
+    @staticmethod
+    def _summary(changeset):
+        '''Aggregate changes per (address) group.'''
+        counts = OrderedDict()
+
+        def count(kind, name, key, amount=1):
+            item = counts.setdefault((kind, name), {'added': 0, 'removed': 0, 'state': None})
+            if key == 'state':
+                item['state'] = amount
+            else:
+                item[key] += amount
+
+        for group in changeset.address_groups_added:
+            count('address group', group.name, 'state', 'create')
+            count('address group', group.name, 'added', len(group.addresses))
+        for group, added, removed in changeset.address_groups_updated:
+            count('address group', group.name, 'added', len(added))
+            count('address group', group.name, 'removed', len(removed))
+        for group in changeset.groups_added:
+            count('group', group.name, 'state', 'create')
+        for rgroup, _ in changeset.groups_updated:
+            count('group', rgroup.name, 'state', 'update')
+        for group_name, _ in changeset.rules_added:
+            count('group', group_name, 'added')
+        for group_name, _ in changeset.rules_removed:
+            count('group', group_name, 'removed')
+        for group in changeset.groups_removed:
+            count('group', group.name, 'state', 'remove')
+            count('group', group.name, 'removed', len(group.rules))
+        for group in changeset.address_groups_removed:
+            count('address group', group.name, 'state', 'remove')
+            count('address group', group.name, 'removed', len(group.addresses))
+
+        lines = OrderedDict()
+        for (kind, name), item in counts.items():
+            items = 'addresses' if kind == 'address group' else 'rules'
+            state = f' ({item["state"]})' if item['state'] else ''
+            lines[(kind, name)] = ('  - %s %r%s: +%d/-%d %s', kind.capitalize(), name, state,
+                                   item['added'], item['removed'], items)
+        return lines
+
+
+class JsonlReporter:
+    '''Write every change as one JSON line to stream, log short summary.'''
+    def __init__(self, stream, limit=0):
+        self.stream = stream
+        self.text = TextReporter(limit)
+
+    def report(self, changeset, exclude_tag=None):
+        for record in iter_records(changeset):
+            json.dump(record, self.stream, sort_keys=True)
+            self.stream.write('\n')
+        self.stream.flush()
+        self.text.report(changeset, exclude_tag)
@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright © 2018, GoodData Corporation. All rights reserved.
 
+import functools
 import ipaddress
 import itertools
 import logging
@@ -28,6 +29,30 @@ class Protocol(StrEnum):
     OSPF = 'ospf'
 
 
+# Maximum amount of parsed networks kept around for reuse
+NETWORK_CACHE_SIZE = 2 ** 16
+# Maximum amount of group names (or IDs) kept around for reuse
+NAME_CACHE_SIZE = 2 ** 14
+
+
+@functools.lru_cache(maxsize=NETWORK_CACHE_SIZE)
+def _network(value):
+    '''Parse network, returning the same object for the same value.'''
+    return ipaddress.ip_network(value, False)
+
+
+@functools.lru_cache(maxsize=NAME_CACHE_SIZE)
+def _name(value):
+    '''Return the same string object for the same group name (or ID).'''
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def _enum(cls, value):
+    '''Look up enum member, skipping slow EnumMeta.__call__ for known values.'''
+    return cls(value)
+
+
 class Rule(Base):
     '''Single rule.'''
     def __init__(self,
@@ -37,7 +62,8 @@ class Rule(Base):
                  port_min=None,
                  port_max=None,
                  cidr=None,
-                 group=None):
+                 group=None,
+                 address_group=None):
         self.direction = direction
         self.ethertype = ethertype
         self.protocol = protocol
@@ -45,6 +71,7 @@ class Rule(Base):
         self.port_max = port_max
         self.cidr = cidr
         self.group = group
+        self.address_group = address_group
         self._id = None
 
     def to_dict(self, user=False):
@@ -69,6 +96,8 @@ class Rule(Base):
                 d['cidr'] = (self.cidr,)
             if self.group is not None:
                 d['groups'] = (self.group,)
+            if self.address_group is not None:
+                d['address_groups'] = (self.address_group,)
             return d
         else:
             return {'direction': self.direction,
@@ -77,7 +106,8 @@ class Rule(Base):
                     'port_min': self.port_min,
                     'port_max': self.port_max,
                     'cidr': self.cidr,
-                    'group': self.group}
+                    'group': self.group,
+                    'address_group': self.address_group}
 
     @classmethod
     def from_remote(cls, **kwargs):
@@ -100,7 +130,9 @@ class Rule(Base):
                 'port_min': kwargs['port_range_min'],
                 'port_max': kwargs['port_range_max'],
                 'cidr': kwargs['remote_ip_prefix'],
-                'group': group}
+                'group': group,
+                # Resolved to name by SGManager (if address groups are loaded)
+                'address_group': kwargs.get('remote_address_group_id')}
 
         rule = cls(**info)
         rule._id = kwargs['id']
@@ -143,7 +175,7 @@ class Rule(Base):
             logger.warning(f"Item(s) from 'to' override base option(s): {', '.join(overwritten)}")
 
         if 'cidr' not in kwargs:
-            if 'groups' in kwargs:
+            if 'groups' in kwargs or 'address_groups' in kwargs:
                 cidr = []
             elif 'ethertype' not in kwargs:
                 # XXX: Shouldn't we set ipv6 by default?
@@ -160,12 +192,13 @@ class Rule(Base):
             cidr = kwargs.pop('cidr')
 
         expand_data = {'cidr': cidr,
-                       'group': kwargs.pop('groups', [])}
+                       'group': kwargs.pop('groups', []),
+                       'address_group': kwargs.pop('address_groups', [])}
         exp_location = [{k: v}
                         for k, values in expand_data.items()
                         for v in values]
 
-        # Expand: to × (cidr + groups)
+        # Expand: to × (cidr + groups + address_groups)
         return [cls.from_local(**{**kwargs, **p1, **p2})
                 for p1, p2 in itertools.product(exp_to, exp_location)]
 
@@ -175,7 +208,7 @@ class Rule(Base):
 
     @direction.setter
     def direction(self, value):
-        self._direction = Direction(value)
+        self._direction = _enum(Direction, value)
 
     @property
     def ethertype(self):
@@ -195,7 +228,7 @@ class Rule(Base):
 
     @ethertype.setter
     def ethertype(self, value):
-        self._ethertype = EtherType(value) if value is not None else None
+        self._ethertype = _enum(EtherType, value) if value is not None else None
 
     @property
     def protocol(self):
@@ -203,7 +236,7 @@ class Rule(Base):
 
     @protocol.setter
     def protocol(self, value):
-        self._protocol = Protocol(value) if value is not None else None
+        self._protocol = _enum(Protocol, value) if value is not None else None
 
     @staticmethod
     def _check_port(port):
@@ -237,7 +270,24 @@ class Rule(Base):
 
     @cidr.setter
     def cidr(self, value):
-        self._cidr = ipaddress.ip_network(value, False) if value is not None else None
+        self._cidr = _network(value) if value is not None else None
+
+    @property
+    def group(self):
+        return self._group
+
+    @group.setter
+    def group(self, value):
+        # Same names (or IDs) repeat in thousands of rules
+        self._group = _name(value) if isinstance(value, str) else value
+
+    @property
+    def address_group(self):
+        return self._address_group
+
+    @address_group.setter
+    def address_group(self, value):
+        self._address_group = _name(value) if isinstance(value, str) else value
 
     def validate(self):
         '''Validate rule.'''
@@ -0,0 +1,667 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2018, GoodData Corporation. All rights reserved.
+
+'''Fake cloud implementing subset of OpenStack API used by SGManager.
+
+It can be used in-process (as a connection passed to SGManager) or served
+over HTTP mimicking Neutron API. Latency, rate limits, errors, quotas and
+pagination are configurable so that full updates can be load-tested.
+'''
+
+import argparse
+from collections import Counter
+import functools
+import json
+import logging
+import pathlib
+import random
+import socketserver
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedError(Exception):
+    '''Error injected by the simulator.'''
+    status = 500
+
+
+class NotFound(SimulatedError):
+    status = 404
+
+
+class Conflict(SimulatedError):
+    status = 409
+
+
+class QuotaExceeded(Conflict):
+    pass
+
+
+class RateLimited(SimulatedError):
+    status = 429
+
+
+def _api(func):
+    '''Apply latency, rate limiting and error injection to API call.'''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self._before_call(func.__name__)
+        with self._lock:
+            result = func(self, *args, **kwargs)
+        if isinstance(result, list) and self.page_size:
+            # First page has been accounted for already
+            pages = max(1, -(-len(result) // self.page_size))
+            delay = self._latency(func.__name__) * (pages - 1)
+            if delay:
+                time.sleep(delay)
+        return result
+    return wrapper
+
+
+class FakeCloud:
+    '''In-memory cloud with security groups and their rules.
+
+    :param latency: seconds per call, either number or mapping of method
+                    name to seconds (key 'default' is used for the rest)
+    :param rate_limit: maximum amount of calls per second (None = unlimited),
+                       bursts of up to max(1, rate_limit) calls are allowed
+    :param errors: mapping of method name to probability of failure
+    :param quotas: mapping with 'security_group', 'security_group_rule' and 'address_group'
+    :param page_size: listing returns data in pages, each costing latency
+    :param secgroup_source: 'neutron' or 'nova' (no network service, rules are
+                            only embedded in groups)
+    '''
+    def __init__(self, project='test', latency=0.0, rate_limit=None, errors=None,
+                 quotas=None, page_size=None, seed=None, secgroup_source='neutron'):
+        self.project = project
+        self.secgroup_source = secgroup_source
+        self.project_id = uuid.uuid5(uuid.NAMESPACE_OID, project).hex
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.errors = dict(errors or {})
+        self.quotas = {'security_group': None,
+                       'security_group_rule': None,
+                       'address_group': None,
+                       **(quotas or {})}
+        self.page_size = page_size
+        self.calls = Counter()
+        self.failures = Counter()
+        self.groups = {}
+        self.rules = {}
+        self.address_groups = {}
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._tokens = max(1, rate_limit) if rate_limit is not None else None
+        self._refilled = time.monotonic()
+        self.network = _NetworkProxy(self)
+
+    def _latency(self, method):
+        if isinstance(self.latency, dict):
+            return self.latency.get(method, self.latency.get('default', 0.0))
+        return self.latency
+
+    def _before_call(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                self._tokens = min(max(1, self.rate_limit),
+                                   self._tokens + (now - self._refilled) * self.rate_limit)
+                self._refilled = now
+                if self._tokens < 1:
+                    self.failures[method] += 1
+                    raise RateLimited(f'Rate limit of {self.rate_limit} calls/s exceeded')
+                self._tokens -= 1
+            fail = self._random.random() < self.errors.get(method, 0.0)
+
+        delay = self._latency(method)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            with self._lock:
+                self.failures[method] += 1
+            raise SimulatedError(f'Injected failure of {method}')
+
+    def _check_quota(self, resource, used):
+        limit = self.quotas.get(resource)
+        if limit is not None and limit >= 0 and used >= limit:
+            raise QuotaExceeded(f'Quota exceeded for resources: [{resource!r}]')
+
+    def _find_group(self, name_or_id):
+        if name_or_id in self.groups:
+            return self.groups[name_or_id]
+        found = [group for group in self.groups.values() if group['name'] == name_or_id]
+        if len(found) != 1:
+            raise NotFound(f'Security group {name_or_id!r} not found')
+        return found[0]
+
+    def _group_info(self, group, fields=None):
+        info = {**group,
+                'tags': list(group['tags']),
+                'security_group_rules': [dict(self.rules[rule_id])
+                                         for rule_id in group['security_group_rules']]}
+        if fields:
+            info = {key: value for key, value in info.items() if key in fields}
+        # Added by SDK's cloud layer, not by Neutron
+        info['location'] = {'project': {'id': self.project_id, 'name': self.project}}
+        return info
+
+    @staticmethod
+    def _match(item, filters):
+        for key, value in filters.items():
+            if isinstance(value, (list, tuple, set)):
+                if item.get(key) not in value:
+                    return False
+            elif item.get(key) != value:
+                return False
+        return True
+
+    # Public API, compatible with openstack.connection.Connection
+
+    def has_service(self, service_key):
+        return service_key == 'network' and self.secgroup_source == 'neutron'
+
+    @_api
+    def list_security_groups(self, filters=None):
+        filters = dict(filters or {})
+        fields = filters.pop('fields', None)
+        return [self._group_info(group, fields)
+                for group in self.groups.values()
+                if self._match(group, filters)]
+
+    @_api
+    def list_security_group_rules(self, filters=None):
+        filters = dict(filters or {})
+        fields = filters.pop('fields', None)
+        return [{key: value for key, value in rule.items() if not fields or key in fields}
+                for rule in self.rules.values()
+                if self._match(rule, filters)]
+
+    @_api
+    def create_security_group(self, name, description, project_id=None, tags=None):
+        self._check_quota('security_group', len(self.groups))
+        group = {'id': str(uuid.uuid4()),
+                 'name': name,
+                 'description': description,
+                 'tags': list(tags or ()),
+                 'project_id': self.project_id,
+                 'security_group_rules': []}
+        self.groups[group['id']] = group
+        return self._group_info(group)
+
+    @_api
+    def get_security_group(self, name_or_id):
+        return self._group_info(self._find_group(name_or_id))
+
+    @_api
+    def update_security_group(self, name_or_id, **kwargs):
+        group = self._find_group(name_or_id)
+        group.update((key, value) for key, value in kwargs.items()
+                     if key in ('name', 'description'))
+        return self._group_info(group)
+
+    @_api
+    def delete_security_group(self, name_or_id):
+        group = self._find_group(name_or_id)
+        for rule_id in group['security_group_rules']:
+            del self.rules[rule_id]
+        del self.groups[group['id']]
+        return True
+
+    @_api
+    def create_security_group_rule(self, secgroup_name_or_id, port_range_min=None,
+                                   port_range_max=None, protocol=None, remote_ip_prefix=None,
+                                   remote_group_id=None, direction='ingress', ethertype='IPv4',
+                                   project_id=None, description='', remote_address_group_id=None):
+        group = self._find_group(secgroup_name_or_id)
+        if remote_group_id is not None and remote_group_id not in self.groups:
+            raise NotFound(f'Security group {remote_group_id!r} not found')
+        if (remote_address_group_id is not None and
+                remote_address_group_id not in self.address_groups):
+            raise NotFound(f'Address group {remote_address_group_id!r} not found')
+        rule = {'id': str(uuid.uuid4()),
+                'security_group_id': group['id'],
+                'direction': direction,
+                'ethertype': ethertype,
+                'protocol': protocol,
+                'port_range_min': port_range_min,
+                'port_range_max': port_range_max,
+                'remote_ip_prefix': remote_ip_prefix,
+                'remote_group_id': remote_group_id,
+                'remote_address_group_id': remote_address_group_id,
+                'description': description,
+                'project_id': self.project_id}
+        key = {k: v for k, v in rule.items() if k not in ('id', 'description')}
+        for rule_id in group['security_group_rules']:
+            other = self.rules[rule_id]
+            if all(other[k] == v for k, v in key.items()):
+                raise Conflict(f'Security group rule already exists. Rule id is {rule_id}')
+        self._check_quota('security_group_rule', len(self.rules))
+        self.rules[rule['id']] = rule
+        group['security_group_rules'].append(rule['id'])
+        return dict(rule)
+
+    @_api
+    def delete_security_group_rule(self, rule_id):
+        if rule_id not in self.rules:
+            raise NotFound(f'Security group rule {rule_id!r} not found')
+        rule = self.rules.pop(rule_id)
+        self.groups[rule['security_group_id']]['security_group_rules'].remove(rule_id)
+        return True
+
+    @_api
+    def list_address_groups(self, filters=None):
+        filters = dict(filters or {})
+        return [{**group, 'addresses': list(group['addresses'])}
+                for group in self.address_groups.values()
+                if self._match(group, filters)]
+
+    @_api
+    def create_address_group(self, name, description='', addresses=()):
+        self._check_quota('address_group', len(self.address_groups))
+        group = {'id': str(uuid.uuid4()),
+                 'name': name,
+                 'description': description,
+                 'addresses': list(addresses),
+                 'project_id': self.project_id}
+        self.address_groups[group['id']] = group
+        return dict(group, addresses=list(group['addresses']))
+
+    @_api
+    def get_address_group(self, group_id):
+        group = self._find_address_group(group_id)
+        return dict(group, addresses=list(group['addresses']))
+
+    def _find_address_group(self, group_id):
+        if group_id not in self.address_groups:
+            raise NotFound(f'Address group {group_id!r} not found')
+        return self.address_groups[group_id]
+
+    @_api
+    def add_addresses_to_address_group(self, group_id, addresses):
+        group = self._find_address_group(group_id)
+        group['addresses'].extend(addr for addr in addresses if addr not in group['addresses'])
+        return dict(group, addresses=list(group['addresses']))
+
+    @_api
+    def remove_addresses_from_address_group(self, group_id, addresses):
+        group = self._find_address_group(group_id)
+        group['addresses'] = [addr for addr in group['addresses'] if addr not in addresses]
+        return dict(group, addresses=list(group['addresses']))
+
+    @_api
+    def delete_address_group(self, group_id):
+        self._find_address_group(group_id)
+        if any(rule['remote_address_group_id'] == group_id for rule in self.rules.values()):
+            raise Conflict(f'Address group {group_id} is in use')
+        del self.address_groups[group_id]
+        return True
+
+    @property
+    def current_project_id(self):
+        return self.project_id
+
+    @_api
+    def get_network_quotas(self, name_or_id, details=False):
+        if name_or_id not in (self.project_id, self.project):
+            raise NotFound(f'Project {name_or_id!r} not found')
+        # Neutron has no quota of address groups
+        used = {'security_group': len(self.groups),
+                'security_group_rule': len(self.rules)}
+        quotas = {resource: self.quotas[resource] if self.quotas[resource] is not None else -1
+                  for resource in used}
+        if details:
+            quotas = {resource: {'limit': limit, 'used': used[resource], 'reserved': 0}
+                      for resource, limit in quotas.items()}
+        return _Quota(quotas)
+
+    def load_groups(self, groups, tags=None):
+        '''Seed state from Group objects without going through simulated API.'''
+        created = {}
+        for group in groups:
+            gid = str(uuid.uuid4())
+            created[group.name] = gid
+            self.groups[gid] = {'id': gid,
+                                'name': group.name,
+                                'description': group.description,
+                                'tags': list(tags or group.tags or ()),
+                                'project_id': self.project_id,
+                                'security_group_rules': []}
+        for group in groups:
+            gid = created[group.name]
+            for rule in group.rules:
+                rid = str(uuid.uuid4())
+                self.rules[rid] = {
+                    'id': rid,
+                    'security_group_id': gid,
+                    'direction': rule.direction.value,
+                    'ethertype': rule.ethertype.value,
+                    'protocol': rule.protocol.value if rule.protocol is not None else None,
+                    'port_range_min': rule.port_min,
+                    'port_range_max': rule.port_max,
+                    'remote_ip_prefix': str(rule.cidr) if rule.cidr is not None else None,
+                    'remote_group_id': created[rule.group] if rule.group is not None else None,
+                    'remote_address_group_id': None,
+                    'description': '',
+                    'project_id': self.project_id}
+                self.groups[gid]['security_group_rules'].append(rid)
+
+
+class _Quota(dict):
+    '''Subset of openstack.network.v2.quota.Quota(Details), keyed by attribute names.'''
+    _attributes = {'security_group': 'security_groups',
+                   'security_group_rule': 'security_group_rules'}
+
+    def __init__(self, quotas):
+        super().__init__((self._attributes[key], value) for key, value in quotas.items())
+        self._original = quotas
+
+    def to_dict(self, original_names=False):
+        return dict(self._original) if original_names else dict(self)
+
+
+class _NetworkProxy:
+    '''Subset of openstack.network.v2._proxy.Proxy.'''
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def security_group_rules(self, **query):
+        if not self._cloud.has_service('network'):
+            raise SimulatedError('Network service is not available')
+        yield from self._cloud.list_security_group_rules(query)
+
+    def create_security_group_rule(self, security_group_id, ether_type='IPv4', **attrs):
+        return self._cloud.create_security_group_rule(security_group_id, ethertype=ether_type,
+                                                      **attrs)
+
+    def address_groups(self, **query):
+        yield from self._cloud.list_address_groups(query)
+
+    def create_address_group(self, **attrs):
+        return self._cloud.create_address_group(**attrs)
+
+    def add_addresses_to_address_group(self, address_group, addresses):
+        return self._cloud.add_addresses_to_address_group(address_group, addresses)
+
+    def remove_addresses_from_address_group(self, address_group, addresses):
+        return self._cloud.remove_addresses_from_address_group(address_group, addresses)
+
+    def delete_address_group(self, address_group):
+        return self._cloud.delete_address_group(address_group)
+
+
+class NeutronHandler(BaseHTTPRequestHandler):
+    '''HTTP handler exposing FakeCloud as (subset of) Neutron API v2.0.
+
+    Security groups, their rules, address groups and network quotas of
+    the simulated project are served. Malformed requests are answered with
+    400, any other unexpected failure with 500, both as NeutronError.
+    '''
+    cloud = None
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _send(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    @staticmethod
+    def _neutron_group(info):
+        info = dict(info)
+        info.pop('location', None)
+        return info
+
+    def _page(self, collection, items, query):
+        limit = int(query.get('limit', [0])[0]) or self.cloud.page_size
+        marker = query.get('marker', [None])[0]
+        if marker is not None:
+            ids = [item['id'] for item in items]
+            items = items[ids.index(marker) + 1:] if marker in ids else []
+        body = {collection: items}
+        if limit and len(items) > limit:
+            body[collection] = items = items[:limit]
+            query = {**query, 'limit': [str(limit)], 'marker': [items[-1]['id']]}
+            href = f'{self.path.split("?")[0]}?{urllib.parse.urlencode(query, doseq=True)}'
+            body[f'{collection}_links'] = [{'rel': 'next', 'href': href}]
+        return body
+
+    def _error(self, status, error_type, message):
+        return self._send(status, {'NeutronError': {'type': error_type, 'message': message}})
+
+    def _dispatch(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if parts and parts[-1].endswith('.json'):
+            parts[-1] = parts[-1][:-len('.json')]
+        query = urllib.parse.parse_qs(url.query)
+        if parts[:1] == ['v2.0']:
+            parts = parts[1:]
+        cloud = self.cloud
+        try:
+            filters = {key: value for key, value in query.items()
+                       if key not in ('limit', 'marker')}
+            if parts == ['security-groups'] and method == 'GET':
+                groups = [self._neutron_group(group)
+                          for group in cloud.list_security_groups(filters)]
+                return self._send(200, self._page('security_groups', groups, query))
+            if parts == ['security-group-rules'] and method == 'GET':
+                rules = cloud.list_security_group_rules(filters)
+                return self._send(200, self._page('security_group_rules', rules, query))
+            if parts == ['security-groups'] and method == 'POST':
+                info = self._body()['security_group']
+                group = cloud.create_security_group(info['name'], info.get('description', ''))
+                return self._send(201, {'security_group': self._neutron_group(group)})
+            if len(parts) == 2 and parts[0] == 'security-groups':
+                if method == 'GET':
+                    group = cloud.get_security_group(parts[1])
+                    return self._send(200, {'security_group': self._neutron_group(group)})
+                if method == 'PUT':
+                    info = self._body()['security_group']
+                    group = cloud.update_security_group(parts[1], **info)
+                    return self._send(200, {'security_group': self._neutron_group(group)})
+                if method == 'DELETE':
+                    cloud.delete_security_group(parts[1])
+                    return self._send(204)
+            if parts == ['security-group-rules'] and method == 'POST':
+                info = dict(self._body()['security_group_rule'])
+                # Legacy alias, the rule always belongs to the simulated project
+                info.pop('tenant_id', None)
+                rule = cloud.create_security_group_rule(info.pop('security_group_id'), **info)
+                return self._send(201, {'security_group_rule': rule})
+            if len(parts) == 2 and parts[0] == 'security-group-rules' and method == 'DELETE':
+                cloud.delete_security_group_rule(parts[1])
+                return self._send(204)
+            if parts == ['address-groups'] and method == 'GET':
+                groups = cloud.list_address_groups(filters)
+                return self._send(200, self._page('address_groups', groups, query))
+            if parts == ['address-groups'] and method == 'POST':
+                info = self._body()['address_group']
+                group = cloud.create_address_group(info['name'], info.get('description', ''),
+                                                   info.get('addresses', ()))
+                return self._send(201, {'address_group': group})
+            if len(parts) == 2 and parts[0] == 'address-groups':
+                if method == 'GET':
+                    return self._send(200, {'address_group': cloud.get_address_group(parts[1])})
+                if method == 'DELETE':
+                    cloud.delete_address_group(parts[1])
+                    return self._send(204)
+            if len(parts) == 3 and parts[0] == 'address-groups' and method == 'PUT':
+                addresses = self._body()['address_group']['addresses']
+                if parts[2] == 'add_addresses':
+                    group = cloud.add_addresses_to_address_group(parts[1], addresses)
+                    return self._send(200, {'address_group': group})
+                if parts[2] == 'remove_addresses':
+                    group = cloud.remove_addresses_from_address_group(parts[1], addresses)
+                    return self._send(200, {'address_group': group})
+            if (len(parts) > 1 and parts[0] == 'quotas' and parts[2:] in ([], ['details']) and
+                    method == 'GET'):
+                quotas = cloud.get_network_quotas(parts[1], details=bool(parts[2:]))
+                return self._send(200, {'quota': quotas.to_dict(original_names=True)})
+        except SimulatedError as e:
+            return self._error(e.status, type(e).__name__, str(e))
+        except (KeyError, TypeError, ValueError) as e:
+            return self._error(400, 'HTTPBadRequest', f'Invalid request: {e!r}')
+        except Exception as e:
+            logger.exception('Failed to handle %s %s', method, url.path)
+            return self._error(500, type(e).__name__, str(e))
+        return self._error(404, 'NotFound', f'{method} {url.path}')
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(cloud, host='127.0.0.1', port=9696):
+    '''Create HTTP server for given cloud (call serve_forever() on it).'''
+    handler = type('Handler', (NeutronHandler,), {'cloud': cloud})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def generate_groups(groups, rules, seed=None):
+    '''Generate local groups with given amount of rules each.'''
+    from .group import Group
+    from .rule import Rule
+
+    rnd = random.Random(seed)
+    names = [f'group-{i:05d}' for i in range(groups)]
+    result = []
+    for name in names:
+        group_rules = set()
+        while len(group_rules) < rules:
+            port = rnd.randrange(1, 65536)
+            if rnd.random() < 0.2:
+                group_rules.add(Rule(protocol='tcp', port_min=port, port_max=port,
+                                     group=rnd.choice(names)))
+            else:
+                group_rules.add(Rule(protocol=rnd.choice(('tcp', 'udp')),
+                                     port_min=port, port_max=port,
+                                     cidr=f'10.{rnd.randrange(256)}.{rnd.randrange(256)}.0/24'))
+        result.append(Group(name, rules=group_rules))
+    return result
+
+
+def run_scenario(groups=100, rules=20, change_ratio=0.1, dry_run=False, threshold=None,
+                 seed=None, pipeline=False, workers=None, **cloud_kwargs):
+    '''Run full update of generated groups against fake cloud.
+
+    Remote state is seeded with the same groups, but with change_ratio of
+    rules replaced, so that update has to remove and add them.
+    With pipeline, pipelined_update with given amount of workers is used
+    (local groups are then loaded from a temporary file, which is timed too).
+    Returns dictionary with statistics.
+    '''
+    from .group import Group
+    from .manager import SGManager
+    from .pipeline import DEFAULT_WORKERS, pipelined_update
+    from .utils import dump_groups
+
+    local = generate_groups(groups, rules, seed)
+    rnd = random.Random(seed)
+    stale = generate_groups(groups, rules, None if seed is None else seed + 1)
+    remote = []
+    for lgroup, sgroup in zip(local, stale):
+        keep = [rule for rule in lgroup.rules if rnd.random() >= change_ratio]
+        extra = [rule for rule in sgroup.rules if rule.group is None]
+        extra = extra[:len(lgroup.rules) - len(keep)]
+        remote.append(Group(lgroup.name, rules=keep + extra))
+
+    cloud = FakeCloud(seed=seed, **cloud_kwargs)
+    cloud.load_groups(remote)
+
+    manager = SGManager(cloud)
+    stats = {'groups': groups, 'rules': groups * rules}
+    if pipeline:
+        stats['workers'] = workers = workers or DEFAULT_WORKERS
+    error = None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = pathlib.Path(tmpdir, 'groups.yaml')
+        if pipeline:
+            with config.open('w') as f:
+                dump_groups(local, f)
+        else:
+            manager.local = local
+        start = time.monotonic()
+        try:
+            if pipeline:
+                pipelined_update(manager, config, dry_run=dry_run, threshold=threshold,
+                                 workers=workers)
+            else:
+                manager.load_remote_groups()
+                stats['load_seconds'] = time.monotonic() - start
+                manager.update_remote_groups(dry_run=dry_run, threshold=threshold)
+        except Exception as e:
+            error = e
+        stats['total_seconds'] = time.monotonic() - start
+    stats['calls'] = dict(cloud.calls)
+    stats['failures'] = dict(cloud.failures)
+    stats['error'] = repr(error) if error is not None else None
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fake cloud for load-testing sgmanager')
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--rules', type=int, default=20, help='Rules per group')
+    parser.add_argument('--change-ratio', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds per call')
+    parser.add_argument('--rate-limit', type=float, help='Calls per second')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Probability of failure of every mutating call')
+    parser.add_argument('--page-size', type=int)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Use pipelined update (loading, comparing and applying in parallel)')
+    parser.add_argument('--workers', type=int, help='Worker threads of pipelined update')
+    parser.add_argument('--serve', metavar='PORT', type=int,
+                        help='Serve generated state over HTTP instead of running update')
+    args = parser.parse_args(argv)
+
+    errors = {method: args.error_rate
+              for method in ('create_security_group', 'delete_security_group',
+                             'create_security_group_rule', 'delete_security_group_rule')}
+    cloud_kwargs = {'latency': args.latency,
+                    'rate_limit': args.rate_limit,
+                    'errors': errors,
+                    'page_size': args.page_size}
+    if args.serve is not None:
+        cloud = FakeCloud(seed=args.seed, **cloud_kwargs)
+        cloud.load_groups(generate_groups(args.groups, args.rules, args.seed))
+        server = serve(cloud, port=args.serve)
+        print(f'Serving Neutron API on http://127.0.0.1:{args.serve}/v2.0')
+        server.serve_forever()
+    else:
+        print(json.dumps(run_scenario(args.groups, args.rules, args.change_ratio,
+                                      seed=args.seed, pipeline=args.pipeline,
+                                      workers=args.workers, **cloud_kwargs), indent=2))
+
+
+if __name__ == '__main__':
+    main()
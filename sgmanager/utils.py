@@ -4,10 +4,21 @@
 from abc import ABCMeta, abstractmethod
 from collections import OrderedDict
 from enum import Enum
+import importlib
 import itertools
+import pathlib
+import subprocess
 
+from .exceptions import InvalidConfiguration
 from .yaml import dump
 
+FORMATS = ('yaml', 'json', 'msgpack')
+EXTENSIONS = {'.yaml': 'yaml',
+              '.yml': 'yaml',
+              '.json': 'json',
+              '.msgpack': 'msgpack',
+              '.mpk': 'msgpack'}
+
 
 class StrEnum(str, Enum):
     '''Enum whose values are strings.'''
@@ -48,28 +59,96 @@ class Base(metaclass=ABCMeta):
         return self.from_local(**self.to_dict(True))
 
 
-def validate_groups(groups):
-    '''Validate groups. Including references to other groups from rules.'''
-    for group in groups:
+def git_changed_files(ref, cwd):
+    '''Return paths of files changed in git repository since ref.'''
+    def git(*args):
+        return subprocess.run(('git',) + args, cwd=cwd, check=True,
+                              stdout=subprocess.PIPE,
+                              universal_newlines=True).stdout
+
+    toplevel = pathlib.Path(git('rev-parse', '--show-toplevel').strip())
+    return [toplevel / name
+            for name in git('diff', '--name-only', ref, '--').splitlines()]
+
+
+def validate_groups(groups, address_groups=()):
+    '''Validate groups. Including references to other (address) groups from rules.'''
+    for group in itertools.chain(groups, address_groups):
         group.validate()
 
     lkeys = set(group.name for group in groups)
+    agroups = {group.name: group for group in address_groups}
 
     # Pre-resolve
     for rule in itertools.chain.from_iterable(group.rules for group in groups):
         group = rule.group
         if group is not None and group not in lkeys:
             raise ReferenceError(f'Group {group!r} is referenced but not created')
-
-
-def dump_groups(groups, **kwargs):
-    '''Dump groups to YAML.'''
+        group = rule.address_group
+        if group is not None and group not in agroups:
+            raise ReferenceError(f'Address group {group!r} is referenced but not created')
+        if (group is not None and rule._ethertype is not None and
+                rule.ethertype not in agroups[group].ethertypes):
+            raise InvalidConfiguration(f'Address group {group!r} has no {rule.ethertype.value}'
+                                       f' addresses')
+
+
+def format_module(fmt):
+    '''Return module with load()/dump() functions for given format.'''
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format: {fmt!r}')
+    return importlib.import_module(f'.{fmt}', __package__)
+
+
+def guess_format(path, head=b''):
+    '''Guess format of a document from file extension or its first bytes.'''
+    fmt = EXTENSIONS.get(pathlib.Path(path).suffix.lower())
+    if fmt is not None:
+        return fmt
+    head = head.lstrip()
+    if head[:1] == b'{':
+        return 'json'
+    # fixmap, map 16 and map 32
+    if head[:1] and (0x80 <= head[0] <= 0x8f or head[0] in (0xde, 0xdf)):
+        return 'msgpack'
+    return 'yaml'
+
+
+def load_document(path, fmt=None):
+    '''Load document from file, detecting format if not specified.'''
+    with open(path, 'rb') as f:
+        if fmt is None:
+            fmt = guess_format(path, f.peek(16))
+        return format_module(fmt).load(f)
+
+
+def dump_groups(groups, stream=None, format='yaml', address_groups=(), **kwargs):
+    '''Dump groups (and address groups) to YAML (or other format).
+
+    When stream is given, groups are written into it one by one instead of
+    building the whole document in memory first. Output is the same.
+    '''
+    groups = sorted(groups, key=lambda g: g.name)
     # It's much better to see document and version on the top ;)
-    data = [{group.name: group}
-            for group in sorted(groups, key=lambda g: g.name)]
-    return dump(
-        OrderedDict(
-            {'document': 'sgmanager-groups',
-             'version': 1,
-             'data': data}),
-        **kwargs)
+    header = OrderedDict({'document': 'sgmanager-groups', 'version': 1})
+    if address_groups:
+        header['address_groups'] = [{group.name: group}
+                                    for group in sorted(address_groups, key=lambda g: g.name)]
+
+    if format != 'yaml':
+        data = [{group.name: group} for group in groups]
+        return format_module(format).dump(OrderedDict(header, data=data), stream, **kwargs)
+
+    if stream is None or kwargs.get('default_flow_style', False) is not False:
+        data = [{group.name: group} for group in groups]
+        return dump(OrderedDict(header, data=data), stream, **kwargs)
+
+    dump(header, stream, **kwargs)
+    if not groups:
+        dump({'data': []}, stream, **kwargs)
+        return
+    # Block sequences inside mapping are not indented, so every item can be
+    # emitted as a standalone document
+    stream.write('data:\n')
+    for group in groups:
+        dump([{group.name: group}], stream, **kwargs)
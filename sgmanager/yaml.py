@@ -2,6 +2,7 @@
 # Copyright © 2018, GoodData Corporation. All rights reserved.
 
 import functools
+import ipaddress
 import pathlib
 
 import yaml
@@ -23,6 +24,25 @@ class LocalRepresenter(SafeRepresenter):
     def represent_ordered_dict(self, ordered_dict):
         return self.represent_dict(ordered_dict.items())
 
+    def ignore_aliases(self, data):
+        # Networks are shared between rules, but anchors are not wanted
+        if isinstance(data, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+            return True
+        return super().ignore_aliases(data)
+
+
+class SourcedDict(dict):
+    '''Mapping which remembers file it was loaded from and files included in it.'''
+    source = None
+    _span = None
+    _included = ()
+
+    @property
+    def includes(self):
+        '''Files included (even indirectly) from within the mapping.'''
+        start, end = self._span
+        return frozenset(path for index, path in self._included if start <= index < end)
+
 
 class LocalLoader(SafeLoader):
     '''Safe YAML loader which supports search_path.'''
@@ -31,12 +51,43 @@ class LocalLoader(SafeLoader):
 
         super().__init__(*args, **kwargs)
 
+        if hasattr(self.stream, 'name'):
+            self.source = pathlib.Path(self.stream.name).resolve()
+        else:
+            self.source = None
         if path is None:
-            if hasattr(self.stream, 'name'):
-                path = pathlib.Path(self.stream.name).parent
+            if self.source is not None:
+                path = self.source.parent
             else:
                 path = pathlib.Path.cwd()
         self.search_path = path.resolve()
+        # (position in stream, path) of every included file
+        self.included = []
+
+    def load_included(self, node, stream, **kwargs):
+        '''Load included stream, remembering it and files it includes at node position.'''
+        loader = type(self)(stream, **kwargs)
+        try:
+            data = loader.get_single_data()
+        finally:
+            loader.dispose()
+        index = node.start_mark.index
+        if loader.source is not None:
+            self.included.append((index, loader.source))
+        self.included.extend((index, path) for _, path in loader.included)
+        return data
+
+    def construct_sourced_map(self, node):
+        data = SourcedDict()
+        data.source = self.source
+        data._span = (node.start_mark.index, node.end_mark.index)
+        data._included = self.included
+        yield data
+        data.update(self.construct_mapping(node))
+
+
+LocalLoader.add_constructor('tag:yaml.org,2002:map',
+                            LocalLoader.construct_sourced_map)
 
 
 class LocalDumper(LocalRepresenter, SafeDumper):
@@ -49,10 +100,9 @@ class LocalDumper(LocalRepresenter, SafeDumper):
                                    type(self).represent_base_class)
         self.add_multi_representer(StrEnum,
                                    type(self).represent_str_enum)
-        from ipaddress import IPv4Network, IPv6Network
-        self.add_representer(IPv4Network,
+        self.add_representer(ipaddress.IPv4Network,
                              type(self).represent_to_str)
-        self.add_representer(IPv6Network,
+        self.add_representer(ipaddress.IPv6Network,
                              type(self).represent_to_str)
         from collections import OrderedDict
         self.add_representer(OrderedDict,
@@ -72,7 +122,7 @@ class YamlInclude(BaseYAMLObject):
     def _from_file(cls, loader, node):
         fpath = loader.search_path / loader.construct_yaml_str(node)
         with open(fpath, 'r') as fp:
-            return yaml.load(fp, type(loader))
+            return loader.load_included(node, fp)
 
     @classmethod
     def from_yaml(cls, loader, node):
@@ -96,7 +146,7 @@ class DeprecatedYamlInclude(BaseYAMLObject):
     def from_yaml(cls, loader, node):
         fpath = loader.search_path / loader.construct_yaml_str(node)
         with open(fpath, 'r') as fp:
-            return yaml.load(fp, functools.partial(type(loader), search_path=loader.search_path))
+            return loader.load_included(node, fp, search_path=loader.search_path)
 
 
 class DeprecatedYamlIncludeDir(BaseYAMLObject):
@@ -114,8 +164,8 @@ class DeprecatedYamlIncludeDir(BaseYAMLObject):
         yamls = list(dpath.glob('*.yaml'))
         if not yamls:
             return
-        return yaml.load('\n'.join(f'- !include {yml}' for yml in yamls),
-                         functools.partial(type(loader), search_path=loader.search_path))
+        return loader.load_included(node, '\n'.join(f'- !include {yml}' for yml in yamls),
+                                    search_path=loader.search_path)
 
 
 def load(stream, **kwargs):
@@ -1,13 +1,51 @@
+import io
+import json
+import logging
+import os
 import pathlib
+import subprocess
+import sys
+import threading
+import urllib.error
+import urllib.request
 
 import pytest
 
+from sgmanager.analysis import estimate_costs, find_duplicates, port_masks
+from sgmanager.api import Executor, load_remote, plan
+from sgmanager.address_group import AddressGroup
+from sgmanager.exceptions import InvalidConfiguration, QuotaException, ThresholdException
+from sgmanager.group import Group
 from sgmanager.manager import SGManager
-from sgmanager.utils import dump_groups
+from sgmanager.pipeline import pipelined_update
+from sgmanager.quota import normalize_quotas
+from sgmanager.query import Index
+from sgmanager.report import JsonlReporter, TextReporter
+from sgmanager.rule import Rule
+from sgmanager.simulator import (FakeCloud, RateLimited, SimulatedError, generate_groups,
+                                 run_scenario, serve)
+from sgmanager.utils import dump_groups, validate_groups
 
 EXAMPLES_DIR = pathlib.Path(__file__).parent / 'examples'
 
 
+@pytest.fixture
+def cloud():
+    '''Simulated cloud with ten generated groups of five rules.'''
+    cloud = FakeCloud()
+    cloud.load_groups(generate_groups(10, 5, seed=1))
+    return cloud
+
+
+@pytest.fixture
+def manager(cloud):
+    '''Manager with groups.yaml and remote groups of cloud loaded.'''
+    manager = SGManager(cloud)
+    manager.load_local_groups(EXAMPLES_DIR / 'groups.yaml')
+    manager.load_remote_groups()
+    return manager
+
+
 @pytest.mark.parametrize('config, config_expanded', (
     ('groups.yaml', 'groups.expanded.yaml'),
     ('groups.deprecated.yaml', 'groups.deprecated.expanded.yaml'),
@@ -18,3 +56,447 @@ def test_parse(config, config_expanded):
     with open(EXAMPLES_DIR / config_expanded, 'r') as fp:
         expected = fp.read()
     assert dump_groups(manager.local, default_flow_style=False, width=-1) == expected
+
+
+@pytest.mark.parametrize('config, config_expanded', (
+    ('groups.yaml', 'groups.expanded.yaml'),
+    ('groups.deprecated.yaml', 'groups.deprecated.expanded.yaml'),
+))
+def test_dump_stream(config, config_expanded):
+    manager = SGManager()
+    manager.load_local_groups(EXAMPLES_DIR / config)
+    with open(EXAMPLES_DIR / config_expanded, 'r') as fp:
+        expected = fp.read()
+    stream = io.StringIO()
+    dump_groups(manager.local, stream, default_flow_style=False, width=-1)
+    assert stream.getvalue() == expected
+    stream = io.StringIO()
+    dump_groups([], stream, default_flow_style=False, width=-1)
+    assert stream.getvalue() == dump_groups([], default_flow_style=False, width=-1)
+
+
+@pytest.mark.parametrize('config', ('groups.yaml', 'groups.deprecated.yaml'))
+def test_json_roundtrip(config, tmp_path):
+    manager = SGManager()
+    manager.load_local_groups(EXAMPLES_DIR / config)
+    expected = dump_groups(manager.local)
+    # No extension, format is detected from content
+    path = tmp_path / 'groups'
+    path.write_text(dump_groups(manager.local, format='json'))
+    manager.load_local_groups(path)
+    assert dump_groups(manager.local) == expected
+
+
+@pytest.mark.parametrize('config', ('groups.yaml', 'groups.deprecated.yaml'))
+def test_msgpack_roundtrip(config, tmp_path):
+    pytest.importorskip('msgpack')
+    manager = SGManager()
+    manager.load_local_groups(EXAMPLES_DIR / config)
+    expected = dump_groups(manager.local)
+    path = tmp_path / 'groups'
+    path.write_bytes(dump_groups(manager.local, format='msgpack'))
+    manager.load_local_groups(path)
+    assert dump_groups(manager.local) == expected
+
+
+def test_rule_interning():
+    r1 = Rule.from_local(cidr='10.0.0.0/8', protocol='tcp', port=22, group='test')
+    r2 = Rule.from_local(cidr='10.0.0.0/8', protocol='tcp', port=80, group=''.join(['te', 'st']))
+    assert r1.cidr is r2.cidr
+    assert r1.group is r2.group
+    assert r1 != r2
+
+
+@pytest.mark.parametrize('config, changed, expected', (
+    ('groups.yaml', 'ssh.yaml', {'ssh', 'monitoring'}),
+    ('groups.yaml', 'monitoring-networks.yaml', {'monitoring'}),
+    ('groups.yaml', 'groups.yaml', {'default', 'monitoring'}),
+    ('groups.deprecated.yaml', 'deprecated/monitoring.yaml', {'monitoring', 'ssh'}),
+))
+def test_changed_groups(config, changed, expected):
+    manager = SGManager()
+    manager.load_local_groups(EXAMPLES_DIR / config)
+    assert manager.changed_groups([EXAMPLES_DIR / changed]) == expected
+
+
+def test_query(tmp_path):
+    manager = SGManager()
+    manager.load_local_groups(EXAMPLES_DIR / 'groups.yaml')
+    index = Index(manager.local)
+
+    def names(**kwargs):
+        return sorted(set(name for name, _ in index.query(**kwargs)))
+
+    assert names(protocol='tcp', port_min=22, cidr='192.168.1.0/24') == ['ssh']
+    assert names(protocol='tcp', port_min=22, cidr='10.0.0.0/8') == []
+    assert names(protocol='tcp', port_min=5666, cidr='10.20.0.0/16') == ['monitoring']
+    assert names(protocol='icmp', cidr='10.20.0.0/16') == ['default']
+    assert names(references='monitoring') == ['ssh']
+
+    index.save(tmp_path / 'index')
+    loaded = Index.load(tmp_path / 'index')
+    assert loaded.query(references='monitoring') == index.query(references='monitoring')
+    assert loaded.query(port_min=5666) == index.query(port_min=5666)
+
+    index = Index([Group('ranges', rules=[Rule(protocol='tcp', port_min=start, port_max=stop)
+                                          for start, stop in ((1, 100), (50, 60), (55, 1024),
+                                                              (2000, 3000), (90, 90))])])
+    ports = [(rule.port_min, rule.port_max) for _, rule in index.query(port_min=55, port_max=60)]
+    assert ports == [(1, 100), (50, 60), (55, 1024)]
+    assert [rule.port_min for _, rule in index.query(port_min=90)] == [1, 55, 90]
+    assert index.query(port_min=1500) == []
+    index.add_group(Group('late', rules=[Rule(protocol='tcp', port_min=1000, port_max=2000)]))
+    assert [name for name, _ in index.query(port_min=1500)] == ['late']
+
+
+def test_columnar_diff():
+    pytest.importorskip('numpy')
+    from sgmanager.columnar import RuleTable, diff
+
+    common = [('a', Rule(protocol='tcp', port_min=22, port_max=22, cidr='10.0.0.0/8')),
+              ('a', Rule(protocol='tcp', port_min=80, port_max=80, group='b')),
+              ('b', Rule(protocol='icmp', cidr='::/0'))]
+    local = common + [('a', Rule(protocol='tcp', port_min=22, port_max=22, cidr='10.0.0.0/16')),
+                      ('b', Rule(protocol='tcp', port_min=22, port_max=22, cidr='10.0.0.0/8'))]
+    remote = [('a', Rule(protocol='udp', port_min=22, port_max=22, cidr='10.0.0.0/8')),
+              ('b', Rule(protocol='icmp', cidr='ffff::/64'))] + common
+    names = {}
+    added, removed, unchanged = diff(RuleTable(local, names), RuleTable(remote, names))
+    assert added == local[3:]
+    assert removed == remote[:2]
+    assert unchanged == 3
+
+
+def test_update_simulated(cloud, manager):
+    manager.update_remote_groups(dry_run=False)
+
+    # default group is never touched
+    assert set(group['name'] for group in cloud.groups.values()) == {'monitoring', 'ssh'}
+    manager.load_remote_groups()
+    assert {g.name: set(g.rules) for g in manager.remote} == \
+        {g.name: set(g.rules) for g in manager.local if g.name != 'default'}
+
+
+def test_quota_preflight(cloud, manager):
+    cloud.quotas['security_group'] = len(cloud.groups) + 1
+    # Like SDK, keyed by attribute names, Neutron names with to_dict(original_names=True)
+    quotas = cloud.get_network_quotas(cloud.project_id, details=True)
+    assert quotas['security_groups']['limit'] == len(cloud.groups) + 1
+    assert normalize_quotas(quotas)['security_group']['used'] == len(cloud.groups)
+    with pytest.raises(QuotaException, match='security_group_rule'):
+        normalize_quotas({'security_groups': quotas['security_groups']})
+
+    # Two groups are created before ten are removed, quotas are checked by default
+    with pytest.raises(QuotaException, match='removals first'):
+        manager.update_remote_groups(dry_run=False)
+    assert cloud.calls['create_security_group'] == 0
+    assert cloud.calls['get_network_quotas'] == 2
+
+    cloud.quotas['security_group'] = 1
+    with pytest.raises(QuotaException, match='do not fit'):
+        manager.update_remote_groups(dry_run=False, check_quota=True, removals_first=True)
+    assert manager.update_remote_groups(dry_run=True, check_quota=False)
+
+    cloud.quotas['security_group'] = len(cloud.groups) + 1
+    manager.update_remote_groups(dry_run=False, check_quota=True, removals_first=True)
+    assert set(group['name'] for group in cloud.groups.values()) == {'monitoring', 'ssh'}
+
+
+def test_api(cloud):
+    remote, remote_address_groups = load_remote(cloud)
+    ids = {group.name: group._id for group in remote}
+    web = Group('web', rules=[Rule(protocol='tcp', port_min=80, port_max=80,
+                                   group=ids['group-00001'])])
+    web._id = 'web-id'
+    web._project = 'test'
+
+    # Remote state is not modified, references are resolved in copies
+    changeset = plan(EXAMPLES_DIR / 'groups.yaml', remote + [web], remote_address_groups)
+    assert next(iter(web.rules)).group == ids['group-00001']
+    removed = {group.name: group for group in changeset.groups_removed}
+    assert removed['web'] is not web
+    assert next(iter(removed['web'].rules)).group == 'group-00001'
+
+    clouds = [FakeCloud(project=f'project{i}') for i in range(4)]
+    for i, project in enumerate(clouds):
+        project.load_groups(generate_groups(5, 3, seed=i))
+    with Executor(cloud) as executor:
+        futures = [executor.submit(EXAMPLES_DIR / 'groups.yaml', connection=project,
+                                   dry_run=False)
+                   for project in clouds]
+        futures.append(executor.submit(EXAMPLES_DIR / 'groups.yaml', dry_run=False))
+        changesets = [future.result() for future in futures]
+    for project in clouds + [cloud]:
+        assert set(group['name'] for group in project.groups.values()) == {'monitoring', 'ssh'}
+    assert all(changeset.groups_added for changeset in changesets[:-1])
+
+
+def test_load_remote_nova():
+    cloud = FakeCloud(secgroup_source='nova')
+    cloud.load_groups(generate_groups(10, 5, seed=1))
+    manager = SGManager(cloud)
+    manager.load_remote_groups(['group-00001', 'group-00002'])
+    assert sorted(group.name for group in manager.remote) == ['group-00001', 'group-00002']
+    assert all(len(group.rules) == 5 for group in manager.remote)
+    # Nova has no network quotas
+    assert manager.load_quotas() is None
+
+
+def test_simulator_scenario():
+    stats = run_scenario(20, 10, 0.2, seed=1)
+    assert stats['error'] is None
+    assert stats['calls']['create_security_group_rule'] > 0
+    stats = run_scenario(20, 10, 0.2, seed=1, quotas={'security_group_rule': 0})
+    assert 'QuotaException' in stats['error']
+    assert 'create_security_group_rule' not in stats['calls']
+    stats = run_scenario(20, 10, 0.2, seed=1, pipeline=True, workers=4,
+                         errors={'create_security_group_rule': 0.5})
+    assert stats['workers'] == 4
+    assert 'SimulatedError' in stats['error']
+    assert stats['failures']['create_security_group_rule'] > 0
+
+
+@pytest.mark.parametrize('rate_limit, calls', ((0.5, 1), (3, 3)))
+def test_simulator_rate_limit(rate_limit, calls):
+    cloud = FakeCloud(rate_limit=rate_limit)
+    for _ in range(calls):
+        cloud.list_security_groups()
+    with pytest.raises(RateLimited):
+        cloud.list_security_groups()
+    assert cloud.failures['list_security_groups'] == 1
+
+
+def test_simulator_errors():
+    cloud = FakeCloud(errors={'create_security_group': 1.0}, seed=1)
+    with pytest.raises(SimulatedError, match='Injected failure'):
+        cloud.create_security_group('test', '')
+    assert not cloud.groups
+    assert cloud.failures == {'create_security_group': 1}
+    cloud.list_security_groups()
+
+
+def test_simulator_http(cloud):
+    server = serve(cloud, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/v2.0'
+
+    def request(method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(url + path, data, method=method,
+                                     headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req) as response:
+                return response.status, json.loads(response.read() or b'null')
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    try:
+        gid = next(iter(cloud.groups))
+        status, body = request('GET', f'/security-groups/{gid}')
+        assert status == 200 and body['security_group']['id'] == gid
+        rule = {'security_group_id': gid, 'tenant_id': cloud.project_id,
+                'protocol': 'tcp', 'port_range_min': 1, 'port_range_max': 1}
+        status, body = request('POST', '/security-group-rules', {'security_group_rule': rule})
+        assert status == 201
+        rule['bogus'] = True
+        status, body = request('POST', '/security-group-rules', {'security_group_rule': rule})
+        assert status == 400 and body['NeutronError']['type'] == 'HTTPBadRequest'
+
+        status, body = request('POST', '/address-groups',
+                               {'address_group': {'name': 'vpn', 'addresses': ['10.8.0.0/16']}})
+        assert status == 201
+        agid = body['address_group']['id']
+        status, body = request('PUT', f'/address-groups/{agid}/add_addresses',
+                               {'address_group': {'addresses': ['2001:db8::/32']}})
+        assert body['address_group']['addresses'] == ['10.8.0.0/16', '2001:db8::/32']
+        status, body = request('GET', '/address-groups?name=vpn')
+        assert [group['id'] for group in body['address_groups']] == [agid]
+        assert request('DELETE', f'/address-groups/{agid}')[0] == 204
+
+        status, body = request('GET', f'/quotas/{cloud.project_id}/details.json')
+        assert body['quota']['security_group']['used'] == len(cloud.groups)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_changeset(manager):
+    before = dump_groups(manager.remote)
+
+    changeset = manager.update_remote_groups(dry_run=True)
+    assert dump_groups(manager.remote) == before
+    assert [group.name for group in changeset.groups_added] == ['monitoring', 'ssh']
+    assert len(changeset.groups_removed) == 10
+    assert changeset.changes == 2 + len(changeset.rules_added) + 10 * 6
+    with pytest.raises(ThresholdException):
+        changeset.check_threshold(15)
+
+    manager.apply_changes(changeset)
+    assert not manager.compute_changes()
+
+
+@pytest.mark.parametrize('threshold, columnar, check_quota', (
+    (None, False, False),
+    (100, False, True),
+    (None, True, False),
+))
+def test_pipelined_update(cloud, threshold, columnar, check_quota):
+    if columnar:
+        pytest.importorskip('numpy')
+    manager = SGManager(cloud)
+    changeset = pipelined_update(manager, EXAMPLES_DIR / 'groups.yaml',
+                                 dry_run=False, threshold=threshold, workers=4,
+                                 check_quota=check_quota, columnar=columnar)
+    assert [group.name for group in changeset.groups_added] == ['monitoring', 'ssh']
+    assert not manager.compute_changes()
+    manager.load_remote_groups()
+    assert not manager.compute_changes()
+
+
+def test_find_duplicates():
+    rules = [Rule(protocol='tcp', port_min=port, port_max=port, cidr='10.0.0.0/8')
+             for port in range(1, 11)]
+    groups = [Group('a', rules=rules + [Rule(protocol='tcp', port_min=80, port_max=80, group='a')]),
+              Group('b', rules=rules + [Rule(protocol='tcp', port_min=80, port_max=80, group='b')]),
+              Group('c', rules=rules[1:]),
+              Group('d', rules=[Rule(protocol='udp', port_min=53, port_max=53)]),
+              Group('e')]
+    clusters = find_duplicates(groups, similarity=0.8)
+    assert len(clusters) == 1
+    assert clusters[0].groups == ('a', 'b', 'c')
+    assert not clusters[0].identical
+    assert clusters[0].shared == 9
+    assert clusters[0].savings == 18
+
+    clusters = find_duplicates(groups, similarity=1)
+    assert [(c.groups, c.identical, c.savings) for c in clusters] == [(('a', 'b'), True, 11)]
+
+    # Similar neighbours must not chain dissimilar groups into one cluster
+    rules = [Rule(protocol='tcp', port_min=port, port_max=port, cidr='10.0.0.0/8')
+             for port in range(1, 15)]
+    groups = [Group(name, rules=rules[i:i + 10]) for i, name in enumerate('abcde')]
+    clusters = find_duplicates(groups, similarity=0.8)
+    assert [c.groups for c in clusters] == [('a', 'b'), ('c', 'd')]
+    assert all(c.similarity >= 0.8 and c.shared for c in clusters)
+
+
+def test_find_duplicates_stable():
+    script = (
+        'from sgmanager.analysis import _minhash, rule_sets\n'
+        'from sgmanager.group import Group\n'
+        'from sgmanager.rule import Rule\n'
+        'rules = [Rule(protocol="tcp", port_min=22, port_max=22, group="a"),\n'
+        '         Rule(protocol="udp", port_min=53, port_max=53, cidr="10.0.0.0/8")]\n'
+        'print(_minhash(rule_sets([Group("a", rules=rules)])["a"], [(3, 5), (7, 11)]))\n'
+    )
+    signatures = set()
+    for seed in ('1', '2'):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        signatures.add(subprocess.run([sys.executable, '-c', script], env=env, check=True,
+                                      stdout=subprocess.PIPE).stdout)
+    assert len(signatures) == 1
+
+
+def test_estimate_costs():
+    assert port_masks(None, None) == 1
+    assert port_masks(22, 22) == 1
+    assert port_masks(0, 65535) == 1
+    assert port_masks(1, 65535) == 16
+    assert port_masks(1024, 2047) == 1
+
+    web = Group('web', rules=[Rule(protocol='tcp', port_min=1, port_max=65535, group='lb'),
+                              Rule(protocol='tcp', port_min=22, port_max=22, cidr='10.0.0.0/8')])
+    lb = Group('lb', rules=[Rule(protocol='tcp', port_min=443, port_max=443, cidr='0.0.0.0/0')])
+    db = Group('db', rules=[Rule(protocol='tcp', port_min=5432, port_max=5432, group='web'),
+                            Rule(protocol='tcp', port_min=5432, port_max=5432, group='db')])
+    costs = {cost.group: cost for cost in estimate_costs([web, lb, db], group_ports=10)}
+    assert costs['web'] == ('web', 2, 1, 1, 16 * 10 + 1, 1, 11)
+    assert costs['lb'] == ('lb', 1, 0, 1, 1, 16, 1)
+    assert costs['db'] == ('db', 2, 2, 1, 20, 1, 20)
+    assert [cost.group for cost in estimate_costs([web, lb, db])] == ['web', 'db', 'lb']
+
+    # Every rule has peers only among addresses of its EtherType
+    manager = SGManager()
+    manager.load_local_groups(EXAMPLES_DIR / 'address-groups.yaml')
+    costs = estimate_costs(manager.local, manager.local_address_groups)
+    assert [(cost.group, cost.flows, cost.conntrack) for cost in costs] == [('ssh', 4, 4)]
+
+
+def test_address_groups(tmp_path):
+    manager = SGManager()
+    manager.load_local_groups(EXAMPLES_DIR / 'address-groups.yaml')
+    with open(EXAMPLES_DIR / 'address-groups.expanded.yaml', 'r') as fp:
+        expected = fp.read()
+    assert dump_groups(manager.local, address_groups=manager.local_address_groups,
+                       default_flow_style=False, width=-1) == expected
+
+    # Rules are found by addresses of address group of their EtherType
+    index = Index(manager.local, manager.local_address_groups)
+    assert [rule.address_group for _, rule in index.query(cidr='89.102.10.0/25')] == ['offices']
+    assert [rule.ethertype.value for _, rule in index.query(cidr='2001:db8::/48')] == ['IPv6']
+    assert index.query(cidr='10.0.0.0/8') == []
+    index.save(tmp_path / 'index')
+    loaded = Index.load(tmp_path / 'index')
+    assert loaded.query(cidr='10.8.1.0/24') == index.query(cidr='10.8.1.0/24') != []
+
+    cloud = FakeCloud()
+    # Address group of another project (e.g. visible to admin) is never touched
+    cloud.address_groups['other'] = {'id': 'other', 'name': 'other', 'description': '',
+                                     'addresses': [], 'project_id': 'other'}
+    manager.connection = cloud
+    manager.load_remote_groups()
+    assert manager.remote_address_groups == []
+    manager.update_remote_groups(dry_run=False)
+
+    rules = [rule for rule in cloud.rules.values() if rule['remote_address_group_id']]
+    assert sorted(rule['ethertype'] for rule in rules) == ['IPv4', 'IPv4', 'IPv6']
+    agroups = {group['name']: group for group in cloud.address_groups.values()}
+    assert sorted(agroups) == ['offices', 'other', 'vpn']
+    agroup = agroups['offices']
+    assert sorted(agroup['addresses']) == ['108.171.171.226/32', '89.102.10.0/24']
+
+    manager.load_remote_groups()
+    assert not manager.compute_changes()
+
+    # Changing list of addresses does not touch any rule
+    local = next(group for group in manager.local_address_groups if group.name == 'offices')
+    local.addresses = ['10.0.0.0/8', '89.102.10.0/24']
+    changeset = manager.update_remote_groups(dry_run=False)
+    assert changeset.changes == 2
+    assert not changeset.rules_added and not changeset.rules_removed
+    assert sorted(agroup['addresses']) == ['10.0.0.0/8', '89.102.10.0/24']
+    manager.load_remote_groups()
+    assert not manager.compute_changes()
+
+    rule = Rule(protocol='tcp', port_min=22, port_max=22, address_group='offices')
+    with pytest.raises(InvalidConfiguration, match='no addresses'):
+        validate_groups([Group('ssh', rules=[rule])], [AddressGroup('offices')])
+    rule.ethertype = 'IPv6'
+    with pytest.raises(InvalidConfiguration, match='no IPv6 addresses'):
+        validate_groups([Group('ssh', rules=[rule])], [local])
+
+
+def test_report(caplog, manager):
+    changeset = manager.compute_changes()
+
+    with caplog.at_level(logging.INFO, logger='sgmanager.report'):
+        changeset.report(reporter=TextReporter(limit=None))
+    # Header and every single change
+    assert len(caplog.records) == 1 + 2 + len(changeset.rules_added) + 10
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger='sgmanager.report'):
+        changeset.report(reporter=TextReporter(limit=5))
+    lines = [record.getMessage() for record in caplog.records]
+    assert lines[0] == f'{changeset.changes} changes to be made:'
+    assert lines[1] == "  - Group 'monitoring' (create): +4/-0 rules"
+    assert lines[-1] == '  ... and 7 more groups'
+    assert len(lines) == 7
+
+    stream = io.StringIO()
+    changeset.report(reporter=JsonlReporter(stream))
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert len(records) == 2 + len(changeset.rules_added) + 10
+    assert records[0] == {'action': 'create', 'kind': 'group', 'group': 'monitoring',
+                          'description': 'Monitoring from private networks'}
+    assert records[-1]['action'] == 'remove' and records[-1]['kind'] == 'group'